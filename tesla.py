@@ -43,46 +43,60 @@ Use --help for all options
 """
 
 import os
+import sys
+import atexit
+import functools
+import hashlib
+import mmap
+import csv
 import json
+import bisect
 import argparse
 import fcntl
+import signal
 import logging
 from logging.handlers import RotatingFileHandler
 import traceback
 import time
 import random
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
 import datetime
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from tl_tweets import tweet_string
 from tl_email import email
 from tl_weather import get_daytime_weather_data
 import glob
 from pythonjsonlogger import jsonlogger
 import teslapy
+import requests
 from selenium import webdriver
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
-# Where logging output from this tool goes. Modify path as needed
-LOGFILE = os.path.expanduser(os.environ['TESLA_LOGFILE'])
-
 log = logging.getLogger(__name__)
 loglevel = logging.INFO
 DEF_FRMT = "%(asctime)s : %(levelname)-8s : %(funcName)-25s:%(lineno)-4s: %(message)s"
-loghandler1 = RotatingFileHandler(LOGFILE, maxBytes=5 * 1024 * 1024, backupCount=8)
-loghandler2 = RotatingFileHandler(LOGFILE + '.json', maxBytes=5 * 1024 * 1024, backupCount=8)
-loghandler1.setFormatter(logging.Formatter(DEF_FRMT))
-loghandler2.setFormatter(jsonlogger.JsonFormatter())
-log.addHandler(loghandler1)
-log.addHandler(loghandler2)
-log.setLevel(loglevel)
 
 # Data file containing all the saved state information
 DATA_FILE = os.path.expanduser(os.getenv('TESLA_DATA_FILE', "tesla.json"))
 
 # Data file containing all the saved state information
 SLEEP_LOG_FILE = os.path.expanduser(os.getenv('TESLA_SLEEP_LOG_FILE', "sleep_log.csv"))
+sleep_log = None
+sleep_log_writer = None
+
+# Daily state fields reported by --day and --export
+STATE_FIELDS = ("odometer", "soc", "ideal_range", "rated_range", "estimated_range", "charge_energy_added",
+                "charge_miles_added_ideal", "charge_miles_added_rated")
+
+# Daily state entries before this day predate the current set of fields and are skipped in reports
+FIRST_STATE_DAY = "20151030"
 
 # Subdirectory where Tesla state dumps will be saved
 DUMP_DIR = "tesla_state_dumps"
@@ -92,8 +106,38 @@ CAR_NAME = os.environ['TESLA_CAR_NAME']
 
 # Some of the tweets attach pictures. They're randomly chosen from this path
 PICTURES_PATH = os.path.expanduser(os.getenv('TESLA_PICTURES_PATH', "images/favorites"))
-images = glob.glob('images/versions/*')
-VERSION_IMAGES = [entry for entry in images if os.path.isfile(entry)]
+VERSION_IMAGES_PATH = 'images/versions'
+
+# Random source for tweet wording and picture selection
+rng = random.Random()
+
+# When the car was bought, for ownership length in tweets
+OWNERSHIP_START = datetime.date(2014, 4, 21)
+
+# Ways to describe the ownership experience in mileage tweets
+MILEAGE_ADJECTIVES = ("an amazing", "an awesome", "a fantastic", "a great", "a wonderful")
+
+# State sections returned along with the vehicle summary by a vehicle data request
+VEHICLE_DATA_STATES = ("vehicle_state", "charge_state", "climate_state", "drive_state", "gui_settings",
+                       "vehicle_config")
+
+# Vehicles on the account, cached per connection by vehicle_list()
+vehicles = None
+vehicles_by_name = {}
+
+# State sections (by vehicle id) already fetched during this run
+fetched_vehicles = {}
+
+# State sections read by each action. The sections needed by all of a run's actions are requested together
+# (run_endpoints) so a partial fetch still only takes one call
+ACTION_ENDPOINTS = {
+    'mileage': ("vehicle_state",),
+    'chargecheck': ("charge_state",),
+    'state': ("vehicle_state", "charge_state"),
+    'pluggedin': ("charge_state",),
+    'firmware': ("vehicle_state",),
+}
+run_endpoints = set()
 
 # Last time we poked the car in a way it could keep the car awake, stored in datetime.datetime
 last_poke = None
@@ -101,20 +145,56 @@ poked_car = False
 
 # Stop from poking too often, min time in minutes
 MIN_TIME_BETWEEN_POKES = 58
+MIN_POKE_INTERVAL = datetime.timedelta(minutes=MIN_TIME_BETWEEN_POKES)
 
-# Get the collection of pictures
+# Last charge state seen is kept in data["state_cache"] and reused for STATE_CACHE_TTL seconds
+# (or for as long as the car sleeps) instead of querying the car again
+STATE_CACHE_TTL = 300
+CACHED_CHARGE_FIELDS = ("charging_state", "battery_level", "est_battery_range")
+
+# How often and how long (seconds) to poll climate state for temps after starting climate
+CLIMATE_POLL_INTERVAL = 0.5
+CLIMATE_POLL_TIMEOUT = 5
+
+# Get the collection of pictures, the directory is only scanned once per run
+@functools.lru_cache(maxsize=1)
 def get_pics():
     if os.path.exists(PICTURES_PATH):
-        pics = [os.path.join(PICTURES_PATH, f) for f in os.listdir(PICTURES_PATH) if not f.startswith('.')]
+        pics = tuple(os.path.join(PICTURES_PATH, f) for f in os.listdir(PICTURES_PATH) if not f.startswith('.'))
     else:
-        pics = [None, ]
+        pics = (None, )
     return pics
 
 
+# Get the pictures used for firmware version tweets
+@functools.lru_cache(maxsize=1)
+def get_version_images():
+    return tuple(entry for entry in glob.glob(os.path.join(VERSION_IMAGES_PATH, '*')) if os.path.isfile(entry))
+
+
+# Emails and tweets are sent in the background while the run continues, flush_notifications() waits for
+# them before the lock is released
+notifier = ThreadPoolExecutor(max_workers=2)
+pending_notifications = []
+
+# Digests of notifications sent in the last SENT_DIGEST_TTL seconds (persisted in data["sent_digests"]) so a
+# retried run doesn't send the same email or tweet twice
+SENT_DIGEST_TTL = 60 * 60
+sent_digests = {}
+
+# Only one instance of this tool runs at a time, others wait up to LOCK_TIMEOUT seconds for the lock
+LOCK_FILE = '/tmp/tesla.lock'
+LOCK_TIMEOUT = 300
+lock_file = None
+
 # Set to true to disable tweets/data file updates
 DEBUG_MODE = int(os.environ.get('TESLA_DEBUG_MODE'))
 MAX_RETRIES = 3
-RETRY_SLEEP = 10
+# Retries wait a random time up to RETRY_BASE * 2**attempt seconds, capped at RETRY_CAP (full jitter)
+RETRY_BASE = 1.0
+RETRY_CAP = 30.0
+# Longest we'll honor a server's Retry-After for, in seconds
+RETRY_AFTER_CAP = 120
 
 # Get Teslamotors.com login information from environment
 TESLA_EMAIL = None
@@ -123,8 +203,104 @@ TESLA_PASSWORD = None
 if 'TESLA_EMAIL' in os.environ:
     TESLA_EMAIL = os.environ['TESLA_EMAIL']
 
-if not TESLA_EMAIL:
-    raise Exception("Missing Tesla login information")
+# Run the Chrome login window headless. Only useful when login completes without typing into the page.
+AUTH_HEADLESS = int(os.environ.get('TESLA_AUTH_HEADLESS', 0))
+
+
+def configure():
+    # Log file setup and config checks, done by the entry points rather than at import
+    if log.handlers:
+        return
+
+    if not TESLA_EMAIL:
+        raise Exception("Missing Tesla login information")
+
+    # Where logging output from this tool goes. Modify path as needed
+    logfile = os.path.expanduser(os.environ['TESLA_LOGFILE'])
+
+    loghandler1 = RotatingFileHandler(logfile, maxBytes=5 * 1024 * 1024, backupCount=8)
+    loghandler2 = RotatingFileHandler(logfile + '.json', maxBytes=5 * 1024 * 1024, backupCount=8)
+    loghandler1.setFormatter(logging.Formatter(DEF_FRMT))
+    loghandler2.setFormatter(jsonlogger.JsonFormatter())
+    log.addHandler(loghandler1)
+    log.addHandler(loghandler2)
+    log.setLevel(loglevel)
+
+
+def backoff(attempt, base=RETRY_BASE, cap=RETRY_CAP):
+    # Full jitter so cron started runs don't all retry at the same moment
+    return rng.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after(e):
+    # Seconds the server asked us to wait with Retry-After (delay or HTTP date), None if it didn't say
+    if isinstance(e, HTTPError):
+        headers = e.headers
+    elif isinstance(e, requests.HTTPError) and e.response is not None:
+        headers = e.response.headers
+    else:
+        return None
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def retry_delay(e, attempt):
+    # Wait as long as the server asked for (within reason), otherwise back off
+    delay = retry_after(e)
+    return backoff(attempt) if delay is None else min(RETRY_AFTER_CAP, delay)
+
+
+def is_transient(e):
+    # True for errors worth retrying: server errors, timeouts, rate limiting and dropped connections.
+    # Tesla calls raise requests exceptions, urllib ones come from the weather/tweet helpers.
+    if isinstance(e, HTTPError):
+        status = e.code
+    elif isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+    else:
+        return isinstance(e, (URLError, TimeoutError, ConnectionError,
+                              requests.ConnectionError, requests.Timeout))
+    return status >= 500 or status in (408, 429)
+
+
+def notify(func, key=None, **kwargs):
+    # key identifies what is being sent (e.g. ("mileage", 50000)) when the wording can change between retries,
+    # otherwise it's the recipient, subject and message
+    if key is None:
+        key = (kwargs.get("email", ""), kwargs.get("subject", ""), kwargs.get("message", ""))
+    digest = hashlib.sha1("|".join(str(k) for k in key).encode()).hexdigest()
+    if time.time() - sent_digests.get(digest, 0) < SENT_DIGEST_TTL:
+        log.info("Already sent, skipping: %s", kwargs.get("subject") or kwargs.get("message"))
+        return
+    pending_notifications.append((digest, notifier.submit(func, **kwargs)))
+
+
+def flush_notifications():
+    # Wait for queued notifications, returns True if any were sent. tweet_string reports failures by returning
+    # False, those aren't recorded as sent so a retried run tries them again.
+    sent = False
+    for digest, future in pending_notifications:
+        try:
+            if future.result() is False:
+                continue
+            sent_digests[digest] = time.time()
+            sent = True
+        except Exception:
+            log.exception("Problem sending notification")
+    pending_notifications.clear()
+    return sent
 
 
 def mail_exception(e):
@@ -139,7 +315,10 @@ def mail_exception(e):
 
 
 def establish_connection(token=None):
+    global vehicles
     log.debug("Connecting to Tesla")
+    vehicles = None
+    fetched_vehicles.clear()
     tesla = teslapy.Tesla(TESLA_EMAIL, authenticator=custom_auth)
     if not tesla.authorized:
         print("Not authorized, attempting to re-authenticate")
@@ -149,10 +328,28 @@ def establish_connection(token=None):
     return tesla
 
 
+def vehicle_list(c):
+    # Vehicle list is fetched once per connection, vehicle data is refreshed in place on each entry
+    global vehicles, vehicles_by_name
+    if vehicles is None:
+        vehicles = c.vehicle_list()
+        vehicles_by_name = {v["display_name"]: v for v in vehicles}
+    return vehicles
+
+
+def find_vehicle(c, car):
+    vehicle_list(c)
+    return vehicles_by_name.get(car)
+
+
 def custom_auth(url):
     options = webdriver.ChromeOptions()
     options.add_argument("--disable-blink-features=AutomationControlled")
-    with webdriver.Chrome(chrome_options=options) as browser:
+    if AUTH_HEADLESS:
+        options.add_argument("--headless=new")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--no-sandbox")
+    with webdriver.Chrome(options=options) as browser:
         browser.get(url)
         WebDriverWait(browser, 300).until(EC.url_contains('void/callback'))
         return browser.current_url
@@ -173,9 +370,23 @@ def wake_vehicle(v):
         log.info("Car was already awake")
 
 
-def get_vehicle_data(v, force_wake):
+def request_vehicle_data(v, endpoints):
+    # TeslaPy's get_vehicle_data() takes no arguments and always asks for everything, so limit the request to
+    # the given state sections by calling the endpoint directly (extra api() arguments become query parameters)
+    v.update(v.api('VEHICLE_DATA', endpoints=";".join(sorted(endpoints)))['response'])
+    v.timestamp = time.time()
+    return v
+
+
+def get_vehicle_data(v, force_wake, endpoints=None, refresh=False):
+    # endpoints limits the request to just those state sections, all of VEHICLE_DATA_STATES by default.
+    # refresh requests them again even if they were already fetched this run.
     global last_poke
     global poked_car
+    wanted = set(endpoints or VEHICLE_DATA_STATES)
+    if not force_wake and not refresh and wanted <= fetched_vehicles.get(v["id"], set()):
+        # Already have this run's data for the car, don't poke it again
+        return v
     if last_poke:
         time_since_last_poke = datetime.datetime.now() - last_poke
     else:
@@ -192,8 +403,7 @@ def get_vehicle_data(v, force_wake):
         do_poke = True
         offline = True
     else:
-        if time_since_last_poke != 'unknown' and \
-                time_since_last_poke < datetime.timedelta(minutes=MIN_TIME_BETWEEN_POKES):
+        if time_since_last_poke != 'unknown' and time_since_last_poke < MIN_POKE_INTERVAL:
             log.info(f"Car poked too recently, not getting data (poked {time_since_last_poke} ago)")
         else:
             do_poke = True
@@ -202,7 +412,13 @@ def get_vehicle_data(v, force_wake):
         # Could wake/keep car awake longer
         if not poked_car:
             log.info(f"Getting {'offline ' if offline else ''}vehicle data (poked {time_since_last_poke} ago)")
-        v.get_vehicle_data()
+        if endpoints:
+            if not refresh:
+                wanted |= run_endpoints
+            request_vehicle_data(v, wanted)
+        else:
+            v.get_vehicle_data()
+        fetched_vehicles.setdefault(v["id"], set()).update(wanted)
         if not offline:
             last_poke = datetime.datetime.now()
             poked_car = True
@@ -214,15 +430,10 @@ def get_vehicle_data(v, force_wake):
 
 
 def tweet_major_mileage(miles, get_tweet=False):
-    m = "{:,}".format(miles)
-    a = random.choice(["an amazing",
-                       "an awesome",
-                       "a fantastic",
-                       "a great",
-                       "a wonderful"])
-    message = "Just passed %s miles on my Model S 75D! It's been %s experience. " \
-              "#Tesla @Tesla @Teslarati #bot" % (m, a)
-    pic = random.choice(get_pics())
+    a = rng.choice(MILEAGE_ADJECTIVES)
+    message = f"Just passed {miles:,} miles on my Model S 75D! It's been {a} experience. " \
+              "#Tesla @Tesla @Teslarati #bot"
+    pic = rng.choice(get_pics())
     if DEBUG_MODE:
         print("Would tweet:\n%s with pic: %s" % (message, pic))
         log.info("DEBUG mode, not tweeting: %s with pic: %s", message, pic)
@@ -231,57 +442,58 @@ def tweet_major_mileage(miles, get_tweet=False):
         if get_tweet:
             return message, pic
         else:
-            tweet_string(message=message, log=log, media=pic)
+            # The adjective is picked at random, so identify the tweet by its milestone
+            notify(tweet_string, key=("mileage", miles), message=message, log=log, media=pic)
+
+
+def fetch_all_vehicle_data(c):
+    # Fetch data for every vehicle on the account. One car at a time: get_vehicle_data updates the poke state
+    # and fetched_vehicles, and all cars share the TeslaPy session.
+    return [get_vehicle_data(v, force_wake=False) for v in vehicle_list(c)]
 
 
 def dump_current_tesla_status(c):
-    vehicles = c.vehicle_list()
-    m = ""
-    for v in vehicles:
-        m += "%s status at %s\n" % (v["display_name"], datetime.datetime.today())
-        for i in v:
-            if i != 'display_name':
-                m += "   %s: %s\n" % (i, v[i])
-        vehicle_data = get_vehicle_data(v, force_wake=False)
+    m = []
+    for v, vehicle_data in zip(vehicle_list(c), fetch_all_vehicle_data(c)):
+        m.append(f"{v['display_name']} status at {datetime.datetime.today()}\n")
+        m.extend(f"   {i}: {v[i]}\n" for i in v if i != 'display_name' and i not in VEHICLE_DATA_STATES)
         if vehicle_data:
-            for s in [
-                "vehicle_state",
-                "charge_state",
-                "climate_state",
-                "drive_state",
-                "gui_settings",
-                "vehicle_config",
-            ]:
-                m += "   %s:\n" % s
+            for s in VEHICLE_DATA_STATES:
+                m.append(f"   {s}:\n")
                 if s not in vehicle_data:
                     log.info(f"Didnt find {s} in vehicle data")
                     continue
                 d = vehicle_data[s]
-                for i in d:
-                    m += "      %s: %s\n" % (i, d[i])
-    return m
+                m.extend(f"      {i}: {value}\n" for i, value in d.items())
+    return "".join(m)
+
+
+def add_new_fields(d, known_fields, ts, ignore=()):
+    # Record fields of d not yet in known_fields as first seen on ts, returns the new field names
+    new = sorted((d.keys() - known_fields.keys()).difference(ignore))
+    known_fields.update(dict.fromkeys(new, ts))
+    return new
 
 
-def check_tesla_fields(c, data):
+def check_tesla_fields(c, data, today_ts=None):
     data_changed = False
     new_fields = []
 
-    t = datetime.date.today()
-    ts = t.strftime("%Y%m%d")
+    ts = today_ts or datetime.date.today().strftime("%Y%m%d")
 
     if not "known_fields" in data:
         data["known_fields"] = {}
         data_changed = True
+    known_fields = data["known_fields"]
 
-    vehicles = c.vehicle_list()
-    for v in vehicles:
+    for v in vehicle_list(c):
         log.debug("Processing %s" % v["display_name"])
-        for i in v:
-            if i not in data["known_fields"]:
-                log.debug("found new field %s. Value: %s", i, v[i])
-                new_fields.append(i)
-                data["known_fields"][i] = ts
-                data_changed = True
+        new = add_new_fields(v, known_fields, ts, ignore=VEHICLE_DATA_STATES)
+        for i in new:
+            log.debug("found new field %s. Value: %s", i, v[i])
+        if new:
+            new_fields.extend(new)
+            data_changed = True
         vehicle_data = get_vehicle_data(v, force_wake=False)
         if vehicle_data:
             for s in [
@@ -296,190 +508,229 @@ def check_tesla_fields(c, data):
                     log.info(f"Didnt find {s} in vehicle data")
                     continue
                 d = vehicle_data[s]
-                for i in d:
-                    if i not in data["known_fields"]:
-                        log.info("found new field %s. Value: %s", i, d[i])
-                        new_fields.append(i)
-                        data["known_fields"][i] = ts
-                        data_changed = True
+                new = add_new_fields(d, known_fields, ts)
+                for i in new:
+                    log.info("found new field %s. Value: %s", i, d[i])
+                if new:
+                    new_fields.extend(new)
+                    data_changed = True
 
     if len(new_fields) > 0:
         m = "Found %s new Tesla API fields:\n" % "{:,}".format(len(new_fields))
-        for i in new_fields:
-            m += "\t%s\n" % i
+        m += "".join("\t%s\n" % i for i in new_fields)
         m += "\nRegards,\nRob"
-        email(email=TESLA_EMAIL, message=m, subject="New Tesla API fields detected")
+        notify(email, email=TESLA_EMAIL, message=m, subject="New Tesla API fields detected")
     else:
         log.debug("No new API fields detected.")
     return data_changed, data
 
 
-def get_temps(c, car):
+def has_temps(climate_state):
+    return climate_state.get("inside_temp") is not None and climate_state.get("outside_temp") is not None
+
+
+def get_vehicle_temps(v):
+    # Temps for a vehicle whose data has already been fetched
     inside_temp = None
     outside_temp = None
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            get_vehicle_data(v, force_wake=False)
-            if "climate_state" in v:
-                res = v.command("CLIMATE_ON")
-                log.info("AC start: %s", res)
-                time.sleep(5)
+    if "climate_state" in v:
+        d = v["climate_state"]
+        if not has_temps(d):
+            # Temps aren't reported until climate has run, start it and poll until they show up
+            res = v.command("CLIMATE_ON")
+            log.info("AC start: %s", res)
+            for _ in range(int(CLIMATE_POLL_TIMEOUT / CLIMATE_POLL_INTERVAL)):
+                time.sleep(CLIMATE_POLL_INTERVAL)
+                get_vehicle_data(v, force_wake=False, endpoints=("climate_state",), refresh=True)
                 d = v["climate_state"]
-                log.info("Climate: %s", d)
-                inside_temp = 9.0 / 5.0 * d["inside_temp"] + 32
-                outside_temp = 9.0 / 5.0 * d["outside_temp"] + 32
-                res = v.command("CLIMATE_OFF")
-                log.info("AC stop: %s", res)
+                if has_temps(d):
+                    break
+            res = v.command("CLIMATE_OFF")
+            log.info("AC stop: %s", res)
+        log.info("Climate: %s", d)
+        if has_temps(d):
+            inside_temp = 9.0 / 5.0 * d["inside_temp"] + 32
+            outside_temp = 9.0 / 5.0 * d["outside_temp"] + 32
+    return inside_temp, outside_temp
+
+
+def get_temps(c, car):
+    inside_temp = None
+    outside_temp = None
+    v = find_vehicle(c, car)
+    if v:
+        get_vehicle_data(v, force_wake=False, endpoints=("climate_state",))
+        inside_temp, outside_temp = get_vehicle_temps(v)
     return inside_temp, outside_temp
 
 
 def trigger_garage_door(c, car):
     log.info("Triggering garage door for %s", car)
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            get_vehicle_data(v, force_wake=True)
-            res = v.command("TRIGGER_HOMELINK")
-            log.info("Garage door trigger: %s", res)
+    v = find_vehicle(c, car)
+    if v:
+        get_vehicle_data(v, force_wake=True)
+        res = v.command("TRIGGER_HOMELINK")
+        log.info("Garage door trigger: %s", res)
     return
 
 
 def trigger_sunroof(c, car, state):
     log.info("Setting sunroof to %s for %s", state, car)
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            get_vehicle_data(v, force_wake=True)
-            cmd = {"state": state}
-            res = v.command("CHANGE_SUNROOF_STATE", data=cmd)
-            log.debug("Garage door trigger: %s", res)
+    v = find_vehicle(c, car)
+    if v:
+        get_vehicle_data(v, force_wake=True)
+        cmd = {"state": state}
+        res = v.command("CHANGE_SUNROOF_STATE", data=cmd)
+        log.debug("Garage door trigger: %s", res)
     return
 
 
 def get_odometer(c, car):
     odometer = None
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            vehicle_data = get_vehicle_data(v, force_wake=False)
-            if vehicle_data:
-                d = vehicle_data["vehicle_state"]
-                if "odometer" in d and int(d["odometer"]):
-                    odometer = int(d["odometer"])
-            break
+    v = find_vehicle(c, car)
+    if v:
+        vehicle_data = get_vehicle_data(v, force_wake=False, endpoints=("vehicle_state",))
+        if vehicle_data:
+            d = vehicle_data["vehicle_state"]
+            if "odometer" in d and int(d["odometer"]):
+                odometer = int(d["odometer"])
     if odometer:
         log.info("Mileage: %s", "{:,}".format(int(odometer)))
     return odometer
 
 
-def is_plugged_in(c, car):
-    plugged_in = False
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            vehicle_data = get_vehicle_data(v, force_wake=False)
-            if vehicle_data:
-                d = vehicle_data["charge_state"]
-                # charge_port_door_open and charge_port_latch arent valid for cached data polls
-                charge_door_open = d["charge_port_latch"] == "Disengaged" or d["charge_port_door_open"]
-                state = d["charging_state"]
-                plugged_in = state != "Disconnected"
-                log.info("Door unlatched: %s. State: %s", charge_door_open, state)
-                log.info("Latch: %s Door open: %s", d["charge_port_latch"], d["charge_port_door_open"])
-            break
-    return plugged_in
+def get_charge_state(c, car):
+    # The CACHED_CHARGE_FIELDS of the car's charge state from a single charge_state request, None if no data
+    charge_state = None
+    v = find_vehicle(c, car)
+    if v:
+        vehicle_data = get_vehicle_data(v, force_wake=False, endpoints=("charge_state",))
+        if vehicle_data:
+            d = vehicle_data["charge_state"]
+            # charge_port_door_open and charge_port_latch arent valid for cached data polls
+            charge_door_open = d["charge_port_latch"] == "Disengaged" or d["charge_port_door_open"]
+            log.info("Door unlatched: %s. State: %s", charge_door_open, d["charging_state"])
+            log.info("Latch: %s Door open: %s", d["charge_port_latch"], d["charge_port_door_open"])
+            charge_state = {k: d.get(k) for k in CACHED_CHARGE_FIELDS}
+    return charge_state
+
+
+def get_cached_state(data, ttl=STATE_CACHE_TTL):
+    # Cached charge state if younger than ttl seconds (any age if ttl is None)
+    cache = data.get("state_cache")
+    if cache and (ttl is None or time.time() - cache["ts"] < ttl):
+        return cache["state"]
+    return None
+
+
+def cache_state(data, charge_state):
+    data["state_cache"] = {"ts": time.time(), "state": charge_state}
 
 
 def is_charging(c, car):
     rc = False
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            vehicle_data = get_vehicle_data(v, force_wake=False)
-            if vehicle_data:
-                d = vehicle_data["charge_state"]
-                log.info("Charging State: %s", d["charging_state"])
-                state = d["charging_state"]
-                if state == "Charging" or state == "Complete":
-                    rc = True
-            break
+    v = find_vehicle(c, car)
+    if v:
+        vehicle_data = get_vehicle_data(v, force_wake=False, endpoints=("charge_state",))
+        if vehicle_data:
+            d = vehicle_data["charge_state"]
+            log.info("Charging State: %s", d["charging_state"])
+            state = d["charging_state"]
+            if state == "Charging" or state == "Complete":
+                rc = True
     return rc
 
 
 def get_current_state(c, car, include_temps=False):
     s = None
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            vehicle_data = get_vehicle_data(v, force_wake=False)
-            if vehicle_data:
-                s = {}
-                d = vehicle_data["vehicle_state"]
-                s["odometer"] = d["odometer"] if "odometer" in d else None
-                s["version"] = d["car_version"] if "car_version" in d else None
-                if include_temps:
-                    s["inside_temp"], s["outside_temp"] = get_temps(c, car)
-                d = vehicle_data["charge_state"]
-                s["soc"] = d["battery_level"] if "battery_level" in d else None
-                s["ideal_range"] = d["ideal_battery_range"] if "ideal_battery_range" in d else None
-                s["rated_range"] = d["battery_range"] if "battery_range" in d else None
-                s["estimated_range"] = d["est_battery_range"] if "est_battery_range" in d else None
-                s["charge_energy_added"] = d["charge_energy_added"] if "charge_energy_added" in d else None
-                s["charge_miles_added_ideal"] = d["charge_miles_added_ideal"] if "charge_miles_added_ideal" in d else None
-                s["charge_miles_added_rated"] = d["charge_miles_added_rated"] if "charge_miles_added_rated" in d else None
-                log.debug(s)
-            break
+    v = find_vehicle(c, car)
+    if v:
+        endpoints = ("vehicle_state", "charge_state", "climate_state") if include_temps else \
+            ("vehicle_state", "charge_state")
+        vehicle_data = get_vehicle_data(v, force_wake=False, endpoints=endpoints)
+        if vehicle_data:
+            s = {}
+            d = vehicle_data["vehicle_state"]
+            s["odometer"] = d["odometer"] if "odometer" in d else None
+            s["version"] = d["car_version"] if "car_version" in d else None
+            if include_temps:
+                s["inside_temp"], s["outside_temp"] = get_vehicle_temps(vehicle_data)
+            d = vehicle_data["charge_state"]
+            s["soc"] = d["battery_level"] if "battery_level" in d else None
+            s["ideal_range"] = d["ideal_battery_range"] if "ideal_battery_range" in d else None
+            s["rated_range"] = d["battery_range"] if "battery_range" in d else None
+            s["estimated_range"] = d["est_battery_range"] if "est_battery_range" in d else None
+            s["charge_energy_added"] = d["charge_energy_added"] if "charge_energy_added" in d else None
+            s["charge_miles_added_ideal"] = d["charge_miles_added_ideal"] if "charge_miles_added_ideal" in d else None
+            s["charge_miles_added_rated"] = d["charge_miles_added_rated"] if "charge_miles_added_rated" in d else None
+            log.debug(s)
     return s
 
 
+def get_sleep_log():
+    # Sleep log is opened once per run and line buffered so each poll is written out right away
+    global sleep_log, sleep_log_writer
+    if sleep_log is None:
+        sleep_log = open(SLEEP_LOG_FILE, "a", buffering=1)
+        atexit.register(sleep_log.close)
+        sleep_log_writer = csv.writer(sleep_log, lineterminator="\n")
+    return sleep_log_writer
+
+
 def sleep_check(c, car):
     global poked_car, last_poke
     s = {}
-    for v in c.vehicle_list():
-        if v["display_name"] == car:
-            s['state'] = v['state']
-            s['timestamp'] = datetime.datetime.now()
-            awake = v['state'] not in ('asleep', 'offline')
-            vehicle_data = get_vehicle_data(v, force_wake=False)
-            if vehicle_data:
-                s["soc"] = round(vehicle_data["charge_state"]["battery_level"], 1)
-                s["charging"] = vehicle_data["charge_state"]["charging_state"]
-                s["rated_range"] = round(vehicle_data["charge_state"]["battery_range"], 1)
-                s["battery_heater_on"] = vehicle_data["charge_state"]["battery_heater_on"]
-                if "drive_state" in v:
-                    s["driving"] = "Driving" if vehicle_data["drive_state"]["shift_state"] not in (None, 'P') else "Parked"
-                else:
-                    s["driving"] = ''
-                if not awake:
-                    s["assumed_state"] = "Sleeping"
-                elif s["charging"] != "Charging":
-                    if s["driving"] == "Driving":
-                        s["assumed_state"] = "Driving"
-                    else:
-                        s["assumed_state"] = "Idle"
+    v = find_vehicle(c, car)
+    if v:
+        s['state'] = v['state']
+        s['timestamp'] = datetime.datetime.now()
+        awake = v['state'] not in ('asleep', 'offline')
+        vehicle_data = get_vehicle_data(v, force_wake=False)
+        if vehicle_data:
+            s["soc"] = round(vehicle_data["charge_state"]["battery_level"], 1)
+            s["charging"] = vehicle_data["charge_state"]["charging_state"]
+            s["rated_range"] = round(vehicle_data["charge_state"]["battery_range"], 1)
+            s["battery_heater_on"] = vehicle_data["charge_state"]["battery_heater_on"]
+            if "drive_state" in v:
+                s["driving"] = "Driving" if vehicle_data["drive_state"]["shift_state"] not in (None, 'P') else "Parked"
+            else:
+                s["driving"] = ''
+            if not awake:
+                s["assumed_state"] = "Sleeping"
+            elif s["charging"] != "Charging":
+                if s["driving"] == "Driving":
+                    s["assumed_state"] = "Driving"
                 else:
-                    # If its charging don't treat it as a poke we need to avoid doing again soon
-                    s["assumed_state"] = "Charging"
-                    poked_car = False
-                    last_poke = None
-                s["is_climate_on"] = vehicle_data["climate_state"]["is_climate_on"]
-
-                log_h = open(SLEEP_LOG_FILE, "a")
-                log_h.write(f"{datetime.datetime.now(datetime.timezone.utc).astimezone()},"
-                            f"{s['state']},"
-                            f"{s['soc'] if 'soc' in s else ''},"
-                            f"{s['rated_range'] if 'rated_range' in s else ''},"
-                            f"{s['charging'] if 'charging' in s else ''},"
-                            f"{s['assumed_state'] if 'assumed_state' in s else ''},"
-                            f"{s['driving'] if 'driving' in s else ''},"
-                            f"{s['is_climate_on'] if 'is_climate_on' in s else ''},"
-                            f"{s['battery_heater_on'] if 'battery_heater_on' in s else ''},"
-                            ","
-                            f"{s['timestamp']}"
-                            "\n")
-                log.info(f"Sleep Poll: {s['assumed_state']}", extra=s)
-            return s
+                    s["assumed_state"] = "Idle"
+            else:
+                # If its charging don't treat it as a poke we need to avoid doing again soon
+                s["assumed_state"] = "Charging"
+                poked_car = False
+                last_poke = None
+            s["is_climate_on"] = vehicle_data["climate_state"]["is_climate_on"]
+
+            get_sleep_log().writerow([
+                datetime.datetime.now(datetime.timezone.utc).astimezone(),
+                s['state'],
+                s['soc'],
+                s['rated_range'],
+                s['charging'],
+                s['assumed_state'],
+                s['driving'],
+                s['is_climate_on'],
+                s['battery_heater_on'],
+                '',
+                s['timestamp'],
+            ])
+            log.info(f"Sleep Poll: {s['assumed_state']}", extra=s)
+        return s
 
 
 def load_data():
     global last_poke
     if os.path.exists(DATA_FILE):
         log.debug("Loading existing tesla database")
-        data = json.load(open(DATA_FILE, "r"))
+        data = read_data_file(DATA_FILE)
         log.debug("loaded")
     else:
         log.debug("No existing tesla database found")
@@ -495,51 +746,73 @@ def load_data():
     if "charging" not in data:
         data["charging"] = False
     if "last_poke" in data:
-        last_poke = datetime.datetime.strptime(data["last_poke"],
-                                               '%Y-%m-%dT%H:%M:%S.%f')
+        last_poke = datetime.datetime.fromisoformat(data["last_poke"])
+    sent_digests.update(data.get("sent_digests", {}))
     return data
 
 
+def json_loads(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def json_dumps(data):
+    return orjson.dumps(data) if orjson else json.dumps(data).encode()
+
+
+def read_data_file(path):
+    # orjson can parse straight from a memory map of the file, skipping the copy into a bytes object
+    with open(path, "rb") as f:
+        if orjson and os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+                return orjson.loads(buf)
+        return json_loads(f.read())
+
+
 def save_data(data):
     log.debug("Save tesla database")
     if not DEBUG_MODE:
-        json.dump(data, open(DATA_FILE + ".tmp", "w"))
-        if os.path.exists(DATA_FILE):
-            os.remove(DATA_FILE)
-        os.rename(DATA_FILE + ".tmp", DATA_FILE)
+        with open(DATA_FILE + ".tmp", "wb") as f:
+            f.write(json_dumps(data))
+        os.replace(DATA_FILE + ".tmp", DATA_FILE)
     else:
         log.debug("Skipped saving due to debug mode")
 
 
+def lock_timeout(signum, frame):
+    raise TimeoutError("Timed out waiting for %s" % LOCK_FILE)
+
+
 def get_lock():
-    # Make sure we only run one instance at a time
-    blocked = True
-    max_wait_count = 10
-    while blocked:
-        fp = open('/tmp/tesla.lock', 'w')
-        try:
-            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            blocked = False
-        except:
-            max_wait_count -= 1
-            if max_wait_count == 0:
-                raise Exception("Lock file not getting released. Please investigate")
-            log.debug("Someone else is running this tool right now. Sleeping")
-            time.sleep(30)
+    # Make sure we only run one instance at a time. The lock is held for as long as lock_file stays open.
+    global lock_file
+    lock_file = open(LOCK_FILE, 'a')
+    old_handler = signal.signal(signal.SIGALRM, lock_timeout)
+    signal.alarm(LOCK_TIMEOUT)
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    except TimeoutError:
+        lock_file.close()
+        lock_file = None
+        raise Exception("Lock file not getting released. Please investigate")
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, old_handler)
 
 
 def remove_lock():
-    try:
-        os.remove('/tmp/tesla.lock')
-    except:
-        pass
+    # Closing the file releases the lock. The file itself is left in place, unlinking it would let another
+    # instance lock a fresh file while a third still waits on the old one.
+    global lock_file
+    if lock_file:
+        lock_file.close()
+        lock_file = None
 
 
 def report_yesterday(data):
     # Report on yesterday's mileage/efficiency
-    t = datetime.date.today()
-    today_ts = t.strftime("%Y%m%d")
-    t = t + datetime.timedelta(days=-1)
+    today = datetime.date.today()
+    today_ts = today.strftime("%Y%m%d")
+    t = today + datetime.timedelta(days=-1)
     yesterday_ts = t.strftime("%Y%m%d")
     time_value = t.strftime("%Y-%m-%d")
     try:
@@ -557,23 +830,19 @@ def report_yesterday(data):
             return None, None
         kw_used = data["daily_state_am"][today_ts]["charge_energy_added"]
         if miles_driven > 200:
-            m = "Yesterday I drove my #Tesla %s miles on a road trip! " \
-                "@Tesla #bot" % ("{:,}".format(int(miles_driven)))
+            m = f"Yesterday I drove my #Tesla {int(miles_driven):,} miles on a road trip! @Tesla #bot"
         elif miles_driven == 0:
             mileage = data["daily_state_am"][today_ts]["odometer"]
-            today_ym = datetime.date.today()
-            start_ym = datetime.date(2014, 4, 21)
-            ownership_months = int((today_ym - start_ym).days / 30)
-            m = "Yesterday my #Tesla had a day off. Current mileage is %s miles after %d months " \
-                "@Tesla #bot" % ("{:,}".format(int(mileage)), ownership_months)
+            ownership_months = (today - OWNERSHIP_START).days // 30
+            m = f"Yesterday my #Tesla had a day off. Current mileage is {int(mileage):,} miles " \
+                f"after {ownership_months} months @Tesla #bot"
         elif data["day_charges"] == 0 or data["day_charges"] > 1:
             # Need to skip efficiency stuff here if car didnt charge last night or we charged more than once
             # TODO: Could save prior efficiency from last charge and use that
             day = yesterday_ts
             w = get_daytime_weather_data(log, time_value)
-            m = "Yesterday I drove my #Tesla %s miles. Avg temp %.0fF. " \
-                "@Tesla #bot" \
-                % ("{:,}".format(int(miles_driven)), w["avg_temp"])
+            m = f"Yesterday I drove my #Tesla {int(miles_driven):,} miles. Avg temp {w['avg_temp']:.0f}F. " \
+                "@Tesla #bot"
         else:
             # Drove a distance and charged exactly once since last report, we have enough data
             # to report efficiency.
@@ -584,21 +853,27 @@ def report_yesterday(data):
             # Example, drive somewhere and don't charge -- efficiency is zero.
             # Or drive somewhere, charge at SC, then do normal charge - efficiency will look too high.
             if kw_used > 0 and efficiency > 200 and efficiency < 700:
-                m = "Yesterday I drove my #Tesla %s miles using %.1f kWh with an effic. of %d Wh/mi. Avg temp %.0fF. " \
-                    "@Tesla #bot" \
-                    % ("{:,}".format(int(miles_driven)), kw_used, efficiency, w["avg_temp"])
+                m = f"Yesterday I drove my #Tesla {int(miles_driven):,} miles using {kw_used:.1f} kWh " \
+                    f"with an effic. of {int(efficiency)} Wh/mi. Avg temp {w['avg_temp']:.0f}F. @Tesla #bot"
             else:
-                m = "Yesterday I drove my #Tesla %s miles. Avg temp %.0fF. " \
-                    "@Tesla #bot" % ("{:,}".format(int(miles_driven)), w["avg_temp"])
-        pic = os.path.abspath(random.choice(get_pics()))
-    except:
+                m = f"Yesterday I drove my #Tesla {int(miles_driven):,} miles. Avg temp {w['avg_temp']:.0f}F. " \
+                    "@Tesla #bot"
+        pic = os.path.abspath(rng.choice(get_pics()))
+    except Exception:
         log.exception("Problem reporting on yesterday's driving")
         m = None
         pic = None
     return m, pic
 
 
+def reported_days(daily_state):
+    # Days in date order starting at FIRST_STATE_DAY, YYYYMMDD keys sort by date so bisect finds the start
+    days = sorted(daily_state)
+    return days[bisect.bisect_left(days, FIRST_STATE_DAY):]
+
+
 def get_update_for_yesterday():
+    configure()
     get_lock()
     data = load_data()
     m, pic = report_yesterday(data)
@@ -606,29 +881,28 @@ def get_update_for_yesterday():
     return m, pic
 
 
-def check_current_firmware_version(c, data):
+def check_current_firmware_version(c, data, today=None):
     v = None
     changed = False
     try:
-        v = c.vehicle_list()[0]
-        vehicle_data = get_vehicle_data(v, force_wake=False)
+        v = vehicle_list(c)[0]
+        vehicle_data = get_vehicle_data(v, force_wake=False, endpoints=("vehicle_state",))
         if vehicle_data:
             if "car_version" in vehicle_data["vehicle_state"]:
                 v = vehicle_data["vehicle_state"]["car_version"].split(" ")[0]
             else:
                 return changed
             log.debug("Found firmware version %s", v)
-    except:
+    except Exception:
         log.exception("Problems getting firmware version")
         return changed
 
-    t = datetime.date.today()
+    t = today or datetime.date.today()
     ts = t.strftime("%Y%m%d")
 
     if "firmware" in data:
-        last_date = time.strptime(data["firmware"]["date_detected"], "%Y%m%d")
-        last_date = datetime.date.fromtimestamp(time.mktime(last_date))
-        time_since = (datetime.date.today() - last_date).days
+        last_date = datetime.datetime.strptime(data["firmware"]["date_detected"], "%Y%m%d").date()
+        time_since = (t - last_date).days
 
         if data["firmware"]["version"] != v:
             data["firmware"]["version"] = v
@@ -640,14 +914,14 @@ def check_current_firmware_version(c, data):
         else:
             message = "My 2018 S75D is running firmware version %s. " \
                       "%d days since last update #bot" % (v, time_since)
-        pic = random.choice(VERSION_IMAGES)
+        pic = rng.choice(get_version_images())
 
         if DEBUG_MODE:
             print("Would tweet:\n%s with pic: %s" % (message, pic))
             log.info("DEBUG mode, not tweeting: %s with pic: %s", message, pic)
         else:
             log.info("Tweeting: %s with pic: %s", message, pic)
-            tweet_string(message=message, log=log, media=pic)
+            notify(tweet_string, message=message, log=log, media=pic)
     else:
         data["firmware"] = {}
         data["firmware"]["version"] = v
@@ -656,6 +930,287 @@ def check_current_firmware_version(c, data):
     return changed
 
 
+def do_wake(c, data, args, today, today_ts):
+    # Wake the car up
+    v = find_vehicle(c, CAR_NAME)
+    if v:
+        wake_vehicle(v)
+    return False
+
+
+def do_status(c, data, args, today, today_ts):
+    log.info("Get Status")
+    # Dump current Tesla status
+    try:
+        print(dump_current_tesla_status(c))
+    except Exception as e:
+        log.info(f"Couldn't dump status this pass: {str(e)}")
+    return False
+
+
+def do_dump(c, data, args, today, today_ts):
+    # Dump all of Tesla API state information to disk
+    log.info("Dumping current Tesla state")
+    try:
+        m = dump_current_tesla_status(c)
+        open(os.path.join(DUMP_DIR, "tesla_state_%s.txt" % today_ts), "w").write(m)
+    except Exception as e:
+        log.info(f"Couldn't get dump this pass: {str(e)}")
+    return False
+
+
+def do_fields(c, data, args, today, today_ts):
+    # Check for new Tesla API fields and report if any found
+    log.info("Checking Tesla API fields")
+    data_changed = False
+    try:
+        data_changed, _ = check_tesla_fields(c, data, today_ts=today_ts)
+    except Exception:
+        log.exception("Couldn't check fields this pass")
+    return data_changed
+
+
+def do_mileage(c, data, args, today, today_ts):
+    # Tweet mileage as it crosses 1,000 mile marks
+    log.info("Get mileage")
+    data_changed = False
+    m = None
+    try:
+        m = get_odometer(c, CAR_NAME)
+        if m:
+            if "mileage_tweet" not in data:
+                data["mileage_tweet"] = 0
+            if int(m / 1000) > int(data["mileage_tweet"] / 1000):
+                tweet_major_mileage(int(m / 1000) * 1000)
+                data["mileage_tweet"] = m
+                data_changed = True
+            if today_ts in data["daily_state_am"] and (
+                    'odometer' not in data["daily_state_am"][today_ts] or
+                    not data["daily_state_am"][today_ts]['odometer']
+            ):
+                log.info("Backfilling odometer for start of day")
+                data["daily_state_am"][today_ts]['odometer'] = m
+                data_changed = True
+    except Exception as e:
+        log.info(f"Problems getting odometer: {str(e)}")
+    if not m:
+        log.info("Couldn't get odometer this pass")
+    return data_changed
+
+
+def do_chargecheck(c, data, args, today, today_ts):
+    # Check for charges so we can correctly report daily efficiency
+    log.info("Check for charges")
+    data_changed = False
+    try:
+        m = is_charging(c, CAR_NAME)
+        if not data["charging"] and m:
+            log.debug("State change, not charging to charging")
+            data["charging"] = True
+            data["day_charges"] += 1
+            data_changed = True
+        elif data["charging"] and m is False:
+            log.debug("State change from charging to not charging")
+            data["charging"] = False
+            data_changed = True
+    except Exception as e:
+        log.info(f"Couldn't get charge state this pass: {str(e)}")
+    return data_changed
+
+
+def do_state(c, data, args, today, today_ts):
+    # Save current Tesla state information
+    log.info("Saving Tesla state")
+    retries = 3
+    s = None
+    while retries > 0:
+        try:
+            s = get_current_state(c, CAR_NAME)
+            break
+        except Exception as e:
+            retries -= 1
+            if retries > 0:
+                log.info(f"Problem getting current state, sleeping and trying again: {str(e)}")
+                time.sleep(30)
+    if s is None:
+        log.warning("   Could not fetch current state")
+
+    log.info("Got current state")
+    ts = today_ts
+    hour = datetime.datetime.now().hour
+    if hour < 12:
+        ampm = "am"
+    else:
+        ampm = "pm"
+    tod = "daily_state_%s" % ampm
+    data[tod][ts] = s
+    log.info(f"Added to database in {tod}:{ts}")
+    return True
+
+
+def do_day(c, data, args, today, today_ts):
+    # Show Tesla state information from a given day
+    log.info("Show day info")
+    ts = args.day
+    if ts in data["daily_state_am"]:
+        day_state = data["daily_state_am"][ts]
+        values = [day_state[i] for i in STATE_FIELDS]
+        lines = ["Data for %s am:" % ts]
+        lines.extend("%s: %s" % (i, value) for i, value in zip(STATE_FIELDS, values))
+        lines.append("\nRaw: %s" % "".join("%s\t" % value for value in values))
+        print("\n".join(lines))
+    return False
+
+
+def do_report(c, data, args, today, today_ts):
+    # Show total and average energy added
+    log.info("Generate report")
+    daily_state = data["daily_state_am"]
+    total_energy_added = sum(daily_state[ts]["charge_energy_added"] for ts in reported_days(daily_state))
+    print("Total Energy Added: %s kW" % "{:,.2f}".format(total_energy_added))
+    print("Average Energy Added: %s kW" % "{:,.2f}".format((total_energy_added / len(daily_state))))
+    return False
+
+
+def do_export(c, data, args, today, today_ts):
+    # Export all saved Tesla state information
+    log.info("Export state")
+    daily_state = data["daily_state_am"]
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    writer.writerows([ts] + [daily_state[ts][i] for i in STATE_FIELDS] for ts in reported_days(daily_state))
+    sys.stdout.flush()
+    return False
+
+
+def do_pluggedin(c, data, args, today, today_ts):
+    # Check if the Tesla is plugged in and alert if not
+    log.debug("Checking if Tesla is plugged in")
+    data_changed = False
+    try:
+        charge_state = get_cached_state(data)
+        if charge_state:
+            log.debug("Using recently cached charge state")
+        else:
+            v = find_vehicle(c, CAR_NAME)
+            if v and not is_awake(v):
+                # Plugging in or unplugging wakes the car, so the last state seen is still good
+                log.info("Car asleep, using last known charge state")
+                charge_state = get_cached_state(data, ttl=None)
+            else:
+                charge_state = get_charge_state(c, CAR_NAME)
+                if charge_state:
+                    cache_state(data, charge_state)
+                    data_changed = True
+        if charge_state is None:
+            log.warning("Car sleeping and data, couldnt check plugged in state")
+        elif charge_state["charging_state"] == "Disconnected":
+            if charge_state.get("battery_level"):
+                battery = f"Current battery level is {int(charge_state['battery_level'])}%. " \
+                          f"({int(charge_state['est_battery_range'])} estimated miles)"
+            else:
+                battery = ""
+            message = f"Your car is not plugged in.\n\n{battery}\n\nRegards,\nRob"
+            notify(email, email=TESLA_EMAIL, message=message, subject="Your Tesla isn't plugged in")
+            log.debug("Not plugged in. Queued email notice.")
+        else:
+            log.debug("Its plugged in.")
+    except Exception as e:
+        log.info(f"Problem checking plugged in state: {str(e)}")
+    return data_changed
+
+
+def do_mailtest(c, data, args, today, today_ts):
+    # Test emailing
+    log.debug("Testing email function")
+    message = "Email test from tool.\n\nIf you're getting this its working.\n\nRegards,\nRob"
+    try:
+        email(email=TESLA_EMAIL, message=message, subject="Tesla Email Test")
+        log.debug("Successfully sent the mail.")
+        print("Mail send passed.")
+    except Exception as e:
+        log.info(f"Problem trying to send mail: {str(e)}")
+        print("Mail send failed, see log.")
+    return False
+
+
+def do_yesterday(c, data, args, today, today_ts):
+    log.info("Show yesterday info")
+    m, pic = report_yesterday(data)
+    data["day_charges"] = 0
+
+    if m:
+        if DEBUG_MODE:
+            print("Would tweet:\n%s with pic: %s" % (m, pic))
+            log.debug("DEBUG mode, not tweeting: %s with pic: %s", m, pic)
+        else:
+            log.info("Tweeting: %s with pic: %s", m, pic)
+            notify(tweet_string, message=m, log=log, media=pic)
+    else:
+        log.debug("No update, skipping yesterday report")
+    return True
+
+
+def do_garage(c, data, args, today, today_ts):
+    # Open garage door (experimental as I dont have an AP car)
+    log.info("Open Garage Door")
+    trigger_garage_door(c, CAR_NAME)
+    return False
+
+
+def do_firmware(c, data, args, today, today_ts):
+    # Check firmware version for a change
+    log.info("Check firmware")
+    return check_current_firmware_version(c, data, today=today)
+
+
+def do_sunroof(c, data, args, today, today_ts):
+    # Change sunroof state
+    log.info("Open Sunroof")
+    trigger_sunroof(c, CAR_NAME, args.sunroof)
+    return False
+
+
+def do_sleepcheck(c, data, args, today, today_ts):
+    # Change sleeping state of tesla
+    log.info("Checking sleep state")
+    tries = 0
+    while True:
+        try:
+            sleep_check(c, CAR_NAME)
+            break
+        except Exception as e:
+            log.info(f"Error checking sleep state: {str(e)}")
+            if tries >= 3 or not is_transient(e):
+                break
+            delay = retry_delay(e, tries)
+            log.info("Retrying sleep check in %.1f seconds", delay)
+            time.sleep(delay)
+            tries += 1
+    return False
+
+
+# Actions run for each command line flag that is set, in this order
+ACTIONS = (
+    ('wake', do_wake),
+    ('status', do_status),
+    ('dump', do_dump),
+    ('fields', do_fields),
+    ('mileage', do_mileage),
+    ('chargecheck', do_chargecheck),
+    ('state', do_state),
+    ('day', do_day),
+    ('report', do_report),
+    ('export', do_export),
+    ('pluggedin', do_pluggedin),
+    ('mailtest', do_mailtest),
+    ('yesterday', do_yesterday),
+    ('garage', do_garage),
+    ('firmware', do_firmware),
+    ('sunroof', do_sunroof),
+    ('sleepcheck', do_sleepcheck),
+)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Tesla Control')
     parser.add_argument('--status', help='Get car status', required=False, action='store_true')
@@ -679,11 +1234,17 @@ def main():
     parser.add_argument('--sleepcheck', help='Monitor sleeping state of Tesla', required=False, action='store_true')
     args = parser.parse_args()
 
+    configure()
     get_lock()
     log.debug("--- tesla.py start ---")
 
+    run_endpoints.clear()
+    run_endpoints.update(e for name, endpoints in ACTION_ENDPOINTS.items() if getattr(args, name) for e in endpoints)
+
     data = load_data()
     data_changed = False
+    today = datetime.date.today()
+    today_ts = today.strftime("%Y%m%d")
 
     # Get a connection to the car and manage access token
     if 'token' in data:
@@ -692,237 +1253,23 @@ def main():
         token = None
     try:
         c = establish_connection(token)
-    except:
+    except Exception:
         log.debug("Problems establishing connection")
         c = establish_connection()
 
-    if args.wake:
-        for v in c.vehicle_list():
-            if v["display_name"] == CAR_NAME:
-                wake_vehicle(v)
-
-    if args.status:
-        log.info("Get Status")
-        # Dump current Tesla status
-        try:
-            print(dump_current_tesla_status(c))
-        except Exception as e:
-            log.info(f"Couldn't dump status this pass: {str(e)}")
-
-    if args.dump:
-        # Dump all of Tesla API state information to disk
-        log.info("Dumping current Tesla state")
-        t = datetime.date.today()
-        ts = t.strftime("%Y%m%d")
-        try:
-            m = dump_current_tesla_status(c)
-            open(os.path.join(DUMP_DIR, "tesla_state_%s.txt" % ts), "w").write(m)
-        except Exception as e:
-            log.info(f"Couldn't get dump this pass: {str(e)}")
-
-    if args.fields:
-        # Check for new Tesla API fields and report if any found
-        log.info("Checking Tesla API fields")
-        try:
-            data_changed, data = check_tesla_fields(c, data)
-        except:
-            log.exception("Couldn't check fields this pass")
-
-    if args.mileage:
-        # Tweet mileage as it crosses 1,000 mile marks
-        log.info("Get mileage")
-        m = None
-        try:
-            m = get_odometer(c, CAR_NAME)
-            if m:
-                if "mileage_tweet" not in data:
-                    data["mileage_tweet"] = 0
-                if int(m / 1000) > int(data["mileage_tweet"] / 1000):
-                    tweet_major_mileage(int(m / 1000) * 1000)
-                    data["mileage_tweet"] = m
-                    data_changed = True
-                t = datetime.date.today()
-                today_ts = t.strftime("%Y%m%d")
-                if today_ts in data["daily_state_am"] and (
-                        'odometer' not in data["daily_state_am"][today_ts] or
-                        not data["daily_state_am"][today_ts]['odometer']
-                ):
-                    log.info("Backfilling odometer for start of day")
-                    data["daily_state_am"][today_ts]['odometer'] = m
-                    data_changed = True
-        except Exception as e:
-            log.info(f"Problems getting odometer: {str(e)}")
-        if not m:
-            log.info("Couldn't get odometer this pass")
-
-    if args.chargecheck:
-        # Check for charges so we can correctly report daily efficiency
-        log.info("Check for charges")
-        try:
-            m = is_charging(c, CAR_NAME)
-            if not data["charging"] and m:
-                log.debug("State change, not charging to charging")
-                data["charging"] = True
-                data["day_charges"] += 1
-                data_changed = True
-            elif data["charging"] and m is False:
-                log.debug("State change from charging to not charging")
-                data["charging"] = False
-                data_changed = True
-        except Exception as e:
-            log.info(f"Couldn't get charge state this pass: {str(e)}")
-
-    if args.state:
-        # Save current Tesla state information
-        log.info("Saving Tesla state")
-        retries = 3
-        s = None
-        while retries > 0:
-            try:
-                s = get_current_state(c, CAR_NAME)
-                break
-            except Exception as e:
-                retries -= 1
-                if retries > 0:
-                    log.info(f"Problem getting current state, sleeping and trying again: {str(e)}")
-                    time.sleep(30)
-        if s is None:
-            log.warning("   Could not fetch current state")
-
-        log.info("Got current state")
-        t = datetime.date.today()
-        ts = t.strftime("%Y%m%d")
-        hour = datetime.datetime.now().hour
-        if hour < 12:
-            ampm = "am"
-        else:
-            ampm = "pm"
-        tod = "daily_state_%s" % ampm
-        data[tod][ts] = s
-        log.info(f"Added to database in {tod}:{ts}")
-        data_changed = True
-
-    if args.day:
-        # Show Tesla state information from a given day
-        log.info("Show day info")
-        ts = args.day
-        raw = ""
-        if ts in data["daily_state_am"]:
-            print("Data for %s am:" % ts)
-            for i in ("odometer", "soc", "ideal_range", "rated_range", "estimated_range", "charge_energy_added",
-                      "charge_miles_added_ideal", "charge_miles_added_rated"):
-                print("%s: %s" % (i, data["daily_state_am"][ts][i]))
-                raw += "%s\t" % data["daily_state_am"][ts][i]
-            print("\nRaw: %s" % raw)
-
-    if args.report:
-        # Show total and average energy added
-        log.info("Generate report")
-        total_energy_added = 0
-        for ts in data["daily_state_am"]:
-            if ts < "20151030":
-                continue
-            total_energy_added += data["daily_state_am"][ts]["charge_energy_added"]
-        print("Total Energy Added: %s kW" % "{:,.2f}".format(total_energy_added))
-        print("Average Energy Added: %s kW" % "{:,.2f}".format((total_energy_added / len(data["daily_state_am"]))))
-
-    if args.export:
-        # Export all saved Tesla state information
-        log.info("Export state")
-        for ts in sorted(data["daily_state_am"]):
-            if ts < "20151030":
-                continue
-            print("%s," % ts, end=' ')
-            for i in ("odometer", "soc", "ideal_range", "rated_range", "estimated_range", "charge_energy_added",
-                      "charge_miles_added_ideal", "charge_miles_added_rated"):
-                print("%s," % data["daily_state_am"][ts][i], end=' ')
-            print("")
-
-    if args.pluggedin:
-        # Check if the Tesla is plugged in and alert if not
-        log.debug("Checking if Tesla is plugged in")
-        try:
-            plugged_in = is_plugged_in(c, CAR_NAME)
-            if plugged_in is None:
-                log.warning("Car sleeping and data, couldnt check plugged in state")
-            elif not plugged_in:
-                s = get_current_state(c, CAR_NAME, include_temps=False)
-                message = "Your car is not plugged in.\n\n"
-                if s["soc"]:
-                    message += "Current battery level is %d%%. " \
-                               "(%d estimated miles)" % (s["soc"], int(s["estimated_range"]))
-                message += "\n\nRegards,\nRob"
-                email(email=TESLA_EMAIL, message=message, subject="Your Tesla isn't plugged in")
-                log.debug("Not plugged in. Emailed notice.")
-            else:
-                log.debug("Its plugged in.")
-        except Exception as e:
-            log.info(f"Problem checking plugged in state: {str(e)}")
-
-    if args.mailtest:
-        # Test emailing
-        log.debug("Testing email function")
-        message = "Email test from tool.\n\n"
-        message += "If you're getting this its working."
-        message += "\n\nRegards,\nRob"
-        try:
-            email(email=TESLA_EMAIL, message=message, subject="Tesla Email Test")
-            log.debug("Successfully sent the mail.")
-            print("Mail send passed.")
-        except Exception as e:
-            log.info(f"Problem trying to send mail: {str(e)}")
-            print("Mail send failed, see log.")
-
-    if args.yesterday:
-        log.info("Show yesterday info")
-        m, pic = report_yesterday(data)
-        data["day_charges"] = 0
-        data_changed = True
-
-        if m:
-            if DEBUG_MODE:
-                print("Would tweet:\n%s with pic: %s" % (m, pic))
-                log.debug("DEBUG mode, not tweeting: %s with pic: %s", m, pic)
-            else:
-                log.info("Tweeting: %s with pic: %s", m, pic)
-                tweet_string(message=m, log=log, media=pic)
-        else:
-            log.debug("No update, skipping yesterday report")
-
-    if args.garage:
-        # Open garage door (experimental as I dont have an AP car)
-        log.info("Open Garage Door")
-        trigger_garage_door(c, CAR_NAME)
-
-    if args.firmware:
-        # Check firmware version for a change
-        log.info("Check firmware")
-        data_changed = check_current_firmware_version(c, data)
-
-    if args.sunroof:
-        # Change sunroof state
-        log.info("Open Sunroof")
-        trigger_sunroof(c, CAR_NAME, args.sunroof)
-
-    if args.sleepcheck:
-        # Change sleeping state of tesla
-        log.info("Checking sleep state")
-        tries = 0
-        while True:
-            try:
-                sleep_check(c, CAR_NAME)
-                break
-            except Exception as e:
-                log.info(f"Error checking sleep state: {str(e)}")
-                if tries >= 3:
-                    break
-                time.sleep(10)
-                tries += 1
+    for name, action in ACTIONS:
+        if getattr(args, name):
+            data_changed |= action(c, data, args, today, today_ts)
 
     if poked_car:
         data_changed = True
         data["last_poke"] = last_poke.isoformat()
 
+    if flush_notifications():
+        now = time.time()
+        data["sent_digests"] = {d: ts for d, ts in sent_digests.items() if now - ts < SENT_DIGEST_TTL}
+        data_changed = True
+
     if data_changed:
         save_data(data)
 
@@ -937,23 +1284,22 @@ if __name__ == '__main__':
             break
         except SystemExit:
             break
-        except HTTPError as e:
-            if e.code >= 500 or e.code == 408:
-                log.warning("Transient error from Tesla API: %d", e.code)
-                log.info("Retrying again in %d seconds", RETRY_SLEEP)
-                time.sleep(RETRY_SLEEP)
+        except Exception as e:
+            if is_transient(e) and retry < MAX_RETRIES - 1:
+                log.warning(f"Transient error from Tesla API: {str(e)}")
+                delay = retry_delay(e, retry)
+                log.info("Retrying again in %.1f seconds", delay)
+                time.sleep(delay)
 
                 # Unlock and retry
+                flush_notifications()
                 remove_lock()
-            else:
-                if DEBUG_MODE:
-                    raise
-                else:
-                    mail_exception(traceback.format_exc())
-                break
-        except:
+                continue
             if DEBUG_MODE:
                 raise
             else:
                 mail_exception(traceback.format_exc())
             break
+
+    # Anything still queued from a failed run
+    flush_notifications()
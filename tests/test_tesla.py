@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+
+# tesla.py reads these at import
+os.environ.setdefault('TESLA_CAR_NAME', 'Test Car')
+os.environ.setdefault('TESLA_DEBUG_MODE', '1')
+os.environ.setdefault('WEATHERAPI_API_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import teslapy
+import tesla
+
+
+class FakeTesla:
+    # Stands in for teslapy.Tesla, records endpoint requests instead of sending them
+    def __init__(self):
+        self.calls = []
+
+    def api(self, name, path_vars=None, **kwargs):
+        self.calls.append((name, path_vars, kwargs))
+        return {'response': {'charge_state': {'battery_level': 80}, 'vehicle_state': {'odometer': 1234.5}}}
+
+
+class GetVehicleDataTest(unittest.TestCase):
+    def setUp(self):
+        tesla.fetched_vehicles.clear()
+        tesla.run_endpoints.clear()
+        tesla.last_poke = None
+        tesla.poked_car = False
+        self.api = FakeTesla()
+        # Real TeslaPy Vehicle, so its get_vehicle_data() signature is the pinned one
+        self.vehicle = teslapy.Vehicle({'id': 1, 'id_s': '1', 'state': 'online', 'display_name': 'Test Car'},
+                                       self.api)
+
+    def test_endpoints_passed_as_query_parameter(self):
+        tesla.run_endpoints.update(("charge_state", "vehicle_state"))
+        data = tesla.get_vehicle_data(self.vehicle, force_wake=False, endpoints=("vehicle_state",))
+        self.assertIs(data, self.vehicle)
+        self.assertEqual(self.api.calls, [('VEHICLE_DATA', {'vehicle_id': '1'},
+                                           {'endpoints': 'charge_state;vehicle_state'})])
+        self.assertEqual(data['vehicle_state']['odometer'], 1234.5)
+
+    def test_fetched_sections_not_requested_again(self):
+        tesla.get_vehicle_data(self.vehicle, force_wake=False, endpoints=("charge_state",))
+        tesla.get_vehicle_data(self.vehicle, force_wake=False, endpoints=("charge_state",))
+        self.assertEqual(len(self.api.calls), 1)
+
+    def test_refresh_requests_only_given_sections_again(self):
+        tesla.run_endpoints.update(("charge_state", "climate_state"))
+        tesla.get_vehicle_data(self.vehicle, force_wake=False, endpoints=("climate_state",))
+        tesla.get_vehicle_data(self.vehicle, force_wake=False, endpoints=("climate_state",), refresh=True)
+        self.assertEqual([kwargs for _, _, kwargs in self.api.calls],
+                         [{'endpoints': 'charge_state;climate_state'}, {'endpoints': 'climate_state'}])
+
+    def test_full_fetch_without_endpoints(self):
+        tesla.get_vehicle_data(self.vehicle, force_wake=False)
+        self.assertEqual(self.api.calls, [('VEHICLE_DATA', {'vehicle_id': '1'}, {})])
+
+
+
+class NotifyTest(unittest.TestCase):
+    def setUp(self):
+        tesla.sent_digests.clear()
+        tesla.pending_notifications.clear()
+        self.sent = []
+
+    def send(self, message, succeed=True):
+        self.sent.append(message)
+        return succeed
+
+    def test_failed_tweet_not_recorded(self):
+        tesla.notify(self.send, message="hello", succeed=False)
+        self.assertFalse(tesla.flush_notifications())
+        tesla.notify(self.send, message="hello")
+        self.assertTrue(tesla.flush_notifications())
+        self.assertEqual(self.sent, ["hello", "hello"])
+
+    def test_key_dedupes_reworded_message(self):
+        tesla.notify(self.send, key=("mileage", 50000), message="an amazing experience")
+        tesla.flush_notifications()
+        tesla.notify(self.send, key=("mileage", 50000), message="a great experience")
+        self.assertFalse(tesla.flush_notifications())
+        self.assertEqual(self.sent, ["an amazing experience"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,9 +26,13 @@ Description:
 Email helper functions
 """
 
-import smtplib
 import os
-from email.mime.text import MIMEText
+import atexit
+import contextlib
+import functools
+import queue
+import threading
+import time
 
 # Initialize Mail Items
 DEFAULT_TL_SMTP_SERVER = "127.0.0.1"
@@ -37,60 +41,186 @@ DEFAULT_TL_MAILFROM = "nobody@example.com"
 DEFAULT_TL_SMTP_USER = None
 DEFAULT_TL_SMTP_PASSWORD = None
 
-if 'TL_SMTP_SERVER' in os.environ:
-    TL_SMTP_SERVER = os.environ['TL_SMTP_SERVER']
-else:
-    TL_SMTP_SERVER = DEFAULT_TL_SMTP_SERVER
-
-if 'TL_SMTP_PORT' in os.environ:
-    TL_SMTP_PORT = os.environ['TL_SMTP_PORT']
-else:
-    TL_SMTP_PORT = DEFAULT_TL_SMTP_PORT
-
-if 'TL_SMTP_USER' in os.environ:
-    TL_SMTP_USER = os.environ['TL_SMTP_USER']
-else:
-    TL_SMTP_USER = DEFAULT_TL_SMTP_USER
-
-if 'TL_SMTP_PASSWORD' in os.environ:
-    TL_SMTP_PASSWORD = os.environ['TL_SMTP_PASSWORD']
-else:
-    TL_SMTP_PASSWORD = DEFAULT_TL_SMTP_PASSWORD
-
-if 'TL_MAILFROM' in os.environ:
-    TL_MAILFROM = os.environ['TL_MAILFROM']
-else:
-    TL_MAILFROM = DEFAULT_TL_MAILFROM
+# Up to TL_SMTP_POOL_SIZE connections are kept open. Each is replaced after TL_SMTP_MAX_MSGS messages or
+# once it is TL_SMTP_MAX_AGE seconds old so long running senders stay under provider limits
+DEFAULT_TL_SMTP_POOL_SIZE = 2
+DEFAULT_TL_SMTP_MAX_MSGS = 100
+DEFAULT_TL_SMTP_MAX_AGE = 300
+
+# Headers that are the same for every message after From, To and Subject apart from the body's transfer
+# encoding (%s), 7bit for ASCII bodies and 8bit for UTF-8 ones sent with BODY=8BITMIME
+HEADER_SUFFIX = ("MIME-Version: 1.0\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                 "Content-Transfer-Encoding: %s\r\n\r\n")
+
+
+@functools.lru_cache(maxsize=None)
+def config():
+    # Mail settings from the environment, read on first use so importing this module stays cheap
+    env = os.environ
+    return {
+        'TL_SMTP_SERVER': env.get('TL_SMTP_SERVER', DEFAULT_TL_SMTP_SERVER),
+        'TL_SMTP_PORT': int(env.get('TL_SMTP_PORT', DEFAULT_TL_SMTP_PORT)),
+        'TL_SMTP_USER': env.get('TL_SMTP_USER', DEFAULT_TL_SMTP_USER),
+        'TL_SMTP_PASSWORD': env.get('TL_SMTP_PASSWORD', DEFAULT_TL_SMTP_PASSWORD),
+        'TL_MAILFROM': env.get('TL_MAILFROM', DEFAULT_TL_MAILFROM),
+        'TL_SMTP_POOL_SIZE': int(env.get('TL_SMTP_POOL_SIZE', DEFAULT_TL_SMTP_POOL_SIZE)),
+        'TL_SMTP_MAX_MSGS': int(env.get('TL_SMTP_MAX_MSGS', DEFAULT_TL_SMTP_MAX_MSGS)),
+        'TL_SMTP_MAX_AGE': int(env.get('TL_SMTP_MAX_AGE', DEFAULT_TL_SMTP_MAX_AGE)),
+    }
+
+
+def mime_body(body):
+    # MIME headers and base64 encoded body for a UTF-8 text body, with CRLF line endings
+    from email import policy
+    from email.mime.text import MIMEText
+    # Plain newlines inside the encoded body, the SMTP policy writes the MIME headers with CRLF
+    return MIMEText("\n".join(body.splitlines()), "plain", "utf-8").as_bytes(policy=policy.SMTP)
+
+
+class SMTPSender:
+    """
+    One SMTP connection that is kept open across sends
+
+    The connection is opened on first send, checked with NOOP before being reused and replaced after
+    TL_SMTP_MAX_MSGS messages or TL_SMTP_MAX_AGE seconds.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.messages_sent = 0
+        self.connected_at = 0
+
+    def connect(self):
+        import smtplib
+        cfg = config()
+        # Here we're assuming if its local host sending email there's no login/security, otherwise its secure
+        if cfg['TL_SMTP_SERVER'] != DEFAULT_TL_SMTP_SERVER or cfg['TL_SMTP_PORT'] != 25:
+            server = smtplib.SMTP(cfg['TL_SMTP_SERVER'], cfg['TL_SMTP_PORT'])
+            # Don't leak the socket if the handshake fails. starttls and login send EHLO themselves as needed.
+            with contextlib.ExitStack() as cleanup:
+                cleanup.callback(server.close)
+                server.starttls()
+                server.login(cfg['TL_SMTP_USER'], cfg['TL_SMTP_PASSWORD'])
+                cleanup.pop_all()
+        else:
+            server = smtplib.SMTP(cfg['TL_SMTP_SERVER'])
+        self.server = server
+        self.messages_sent = 0
+        self.connected_at = time.monotonic()
+
+    def ensure_connected(self):
+        import smtplib
+        cfg = config()
+        if self.server is not None and (self.messages_sent >= cfg['TL_SMTP_MAX_MSGS'] or
+                                        time.monotonic() - self.connected_at > cfg['TL_SMTP_MAX_AGE']):
+            self.close()
+        if self.server is not None:
+            try:
+                self.server.noop()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+                self.server = None
+        if self.server is None:
+            self.connect()
+
+    def send(self, to_addr, headers, body):
+        # headers are the CRLF terminated From/To/Subject lines, body the CRLF separated text
+        self.ensure_connected()
+        self.server.ehlo_or_helo_if_needed()
+        options = ()
+        if body.isascii():
+            message = f"{headers}{HEADER_SUFFIX % '7bit'}{body}".encode("utf-8")
+        elif self.server.has_extn("8bitmime"):
+            # Flag 8-bit (UTF-8) bodies so they're passed through as is
+            options = ("BODY=8BITMIME",)
+            message = f"{headers}{HEADER_SUFFIX % '8bit'}{body}".encode("utf-8")
+        else:
+            # Server only takes 7-bit data, let MIME encode the body
+            message = headers.encode("utf-8") + mime_body(body)
+        self.server.sendmail(config()['TL_MAILFROM'], to_addr, message, mail_options=options)
+        self.messages_sent += 1
+
+    def close(self):
+        if self.server is not None:
+            import smtplib
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+            self.server = None
+
+
+class SMTPPool:
+    """
+    Bounded pool of SMTPSender connections
+
+    At most size connections are in use at once, idle ones are reused most recently used first. A connection
+    that fails while sending is closed instead of going back to the pool.
+    """
+
+    def __init__(self, size):
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        with self.slots:
+            try:
+                sender = self.idle.get_nowait()
+            except queue.Empty:
+                sender = SMTPSender()
+            try:
+                yield sender
+            except BaseException:
+                sender.close()
+                raise
+            self.idle.put(sender)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# Created by get_pool() on the first email
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = SMTPPool(config()['TL_SMTP_POOL_SIZE'])
+            atexit.register(pool.close)
+    return pool
+
+
+def header_value(value):
+    # Non-ASCII header values have to be RFC 2047 encoded
+    if value.isascii():
+        return value
+    from email.header import Header
+    return Header(value, "utf-8").encode()
 
 
 def email(email, message, subject, cc=None, bcc=None):
-    msg = MIMEText(message.strip())
-
     # make sure the user provided all the parameters
     if not email:
         raise Exception("A required parameter is missing, please go back and correct the error")
 
-    # create the message text
-    msg['Subject'] = subject
-    msg['From'] = TL_MAILFROM
-    msg['To'] = email
+    # create the message text, SMTP wants CRLF line endings
+    headers = f"From: {config()['TL_MAILFROM']}\r\nTo: {email}\r\nSubject: {header_value(subject)}\r\n"
 
     to_addr = [email]
     if cc:
-        msg['CC'] = ",".join(cc)
+        headers += f"CC: {','.join(cc)}\r\n"
         to_addr += cc
     if bcc:
         to_addr += bcc
 
-    # Here we're assuming if its local host sending email there's no login/security, otherwise its secure
-    if TL_SMTP_SERVER != DEFAULT_TL_SMTP_SERVER or TL_SMTP_PORT != 25:
-        server = smtplib.SMTP(TL_SMTP_SERVER, TL_SMTP_PORT)
-        server.ehlo()
-        server.starttls()
-        server.login(TL_SMTP_USER, TL_SMTP_PASSWORD)
-        server.sendmail(TL_MAILFROM, to_addr, msg.as_string())
-        server.quit()
-    else:
-        server = smtplib.SMTP(TL_SMTP_SERVER)
-        server.sendmail(TL_MAILFROM, to_addr, msg.as_string())
-        server.quit()
+    body = "\r\n".join(message.strip().splitlines())
+    with get_pool().acquire() as sender:
+        sender.send(to_addr, headers, body)
@@ -26,9 +26,30 @@ Description:
 Stock quote helper functions
 """
 
-import urllib.request, urllib.parse, urllib.error
-import json
 import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TL_POLYGON_TOKEN = os.environ.get('TL_POLYGON_TOKEN')
+if not TL_POLYGON_TOKEN:
+    raise Exception("TL_POLYGON_TOKEN missing for stock quotes")
+POLYGON_URL = "https://api.polygon.io/v2/aggs/ticker/%s/prev?adjusted=true&apiKey=" + TL_POLYGON_TOKEN
+
+# Shared session so repeated quotes reuse the TLS connection to polygon.io, transient failures are retried with
+# exponential backoff (honoring Retry-After)
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4,
+                                      max_retries=Retry(total=3, backoff_factor=0.5,
+                                                        status_forcelist=[429, 500, 502, 503, 504],
+                                                        respect_retry_after_header=True)))
+
+# Connect and read timeouts in seconds
+QUOTE_TIMEOUT = (3.05, 10)
 
 
 def get_stock_quote(stock, log):
@@ -39,12 +60,9 @@ def get_stock_quote(stock, log):
     :return:
     """
     log.debug("Get current stock quote for %s" % stock)
-    token = os.getenv("TL_POLYGON_TOKEN")
-
-    data = urllib.request.urlopen(
-        f"https://api.polygon.io/v2/aggs/ticker/{stock}/prev?adjusted=true&apiKey={token}"
-    ).read()
-    json_response = json.loads(data)
+    response = session.get(POLYGON_URL % stock, timeout=QUOTE_TIMEOUT)
+    response.raise_for_status()
+    json_response = orjson.loads(response.content) if orjson else response.json()
     if json_response:
         quote = json_response["results"][0]['c']
     else:
@@ -25,7 +25,6 @@ Description:
 Twitter Helper Functions
 
 Dependencies:
-twython: https://github.com/ryanmcgrath/twython (most twython things no longer work as of APIv2)
 tweepy: https://github.com/tweepy/tweepy
 
 You need to get application keys for Twitter at https://apps.twitter.com
@@ -39,59 +38,99 @@ Provide them via environment variables:
 
 Or via init function.
 
-Note: The logging stuff is as Twython emits a bunch of stuff during its work that I wanted to suppress
+Note: The logging stuff is as the Twitter libraries emit a bunch of stuff during their work that I wanted to suppress
 
-NOTE: ONLY tweet_string HAS BEEN TESTING/IS WORKING WITH TWITTER API 2.0
+All calls use Twitter API v2 through tweepy.Client, except media uploads which are only available in v1.1
 """
 
 import os
-import sys
-import argparse
-import glob
 import time
 import random
 import logging
-from twython import Twython, TwythonAuthError
-import tweepy
+import contextlib
+import threading
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import json
+import re
+import atexit
+from urllib.parse import urlsplit
+
+# tweepy and requests are imported by setup_twitter() on first use so importing this module stays cheap
+tweepy = None
+requests = None
+
+
+# Initialize Twitter Keys from the environment, init_twitter_account() can replace them
+APP_KEY = os.environ.get('TL_APP_KEY')
+APP_SECRET = os.environ.get('TL_APP_SECRET')
+OAUTH_TOKEN = os.environ.get('TL_OAUTH_TOKEN')
+OAUTH_TOKEN_SECRET = os.environ.get('TL_OAUTH_TOKEN_SECRET')
+BEARER_TOKEN = os.environ.get('TL_BEARER_TOKEN')
+
+# Cache self ID, also saved in CACHE_FILE (keyed by the user id part of the access token) across runs
+MYSELF = None
+CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'tl_tweets.json')
 
-basepath = os.path.dirname(sys.argv[0])
-sys.path.append(os.path.join(basepath, 'twython'))
+# Attempts at sending a tweet when Twitter has server or connection problems
+MAX_RETRIES = 5
 
+# Errors that mean the credentials or app permissions need attention, filled in by setup_twitter()
+AUTH_ERRORS = ()
 
-# Initialize Twitter Keys
-APP_KEY = None
-APP_SECRET = None
-OAUTH_TOKEN = None
-OAUTH_TOKEN_SECRET = None
-BEARER_TOKEN = None
+# User fields requested wherever account details are returned
+USER_FIELDS = ["created_at", "description", "public_metrics"]
 
-# Cache self ID
-MYSELF = None
+# Set once the credentials are checked and warnings are routed to logging, cleared by init_twitter_account()
+twitter_ready = False
+
+# API clients, built on first use and reused so calls share their HTTP connections. tweepy_client waits out
+# rate limits for reads and paging, tweet_client is used for tweets and fails fast instead as tweets are sent
+# from cron jobs that hold a lock.
+tweepy_client = None
+tweet_client = None
+media_api = None
 
-if 'TL_APP_KEY' in os.environ:
-    APP_KEY = os.environ['TL_APP_KEY']
+# Screen name to user id, v2 endpoints work on ids
+user_ids = {}
 
-if 'TL_APP_SECRET' in os.environ:
-    APP_SECRET = os.environ['TL_APP_SECRET']
+# Last rate limit seen per endpoint ({"remaining": n, "reset": epoch seconds}), kept in CACHE_FILE between runs
+# so a new run doesn't start by hitting an endpoint whose window is still used up
+rate_limits = {}
+rate_limits_changed = False
 
-if 'TL_OAUTH_TOKEN' in os.environ:
-    OAUTH_TOKEN = os.environ['TL_OAUTH_TOKEN']
+# Longest (seconds) tweet and media requests wait for a used up rate limit to reset, RateLimited is raised
+# rather than waiting longer. Reads and paging wait as long as it takes.
+RATE_LIMIT_MAX_WAIT = 5
 
-if 'TL_OAUTH_TOKEN_SECRET' in os.environ:
-    OAUTH_TOKEN_SECRET = os.environ['TL_OAUTH_TOKEN_SECRET']
 
-if 'TL_BEARER_TOKEN' in os.environ:
-    BEARER_TOKEN = os.environ['TL_BEARER_TOKEN']
+class RateLimited(Exception):
+    pass
+
+# Loggers of the libraries behind tweepy calls, quiet() only lets errors from them through. The caller's own
+# logger is left alone as tweets can be sent from a background thread while the caller keeps logging.
+LIBRARY_LOGGERS = ("tweepy", "requests_oauthlib", "oauthlib", "urllib3")
+quiet_lock = threading.Lock()
+quiet_depth = 0
+quiet_levels = {}
 
 
 def init_twitter_account(app_key, app_secret, oauth_token, oauth_token_secret, bearer_token=None):
     global APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET, BEARER_TOKEN, MYSELF
+    global tweepy_client, tweet_client, media_api, twitter_ready
+    save_rate_limits()
     APP_KEY = app_key
     APP_SECRET = app_secret
     OAUTH_TOKEN = oauth_token
     OAUTH_TOKEN_SECRET = oauth_token_secret
     BEARER_TOKEN = bearer_token
     MYSELF = None
+    tweepy_client = None
+    tweet_client = None
+    media_api = None
+    clear_caches()
+    twitter_ready = False
 
 
 def check_twitter_config():
@@ -107,174 +146,389 @@ def check_twitter_config():
         raise Exception("BEARER_TOKEN missing for twitter")
 
 
-def twitter_auth_issue(e):
-    message = "There was a problem with automated tweet operations.\n\n"
-    message += "\nPlease investigate."
-    print(message, file=sys.stderr)
+def token_user_id():
+    # Access tokens start with the id of the user they belong to
+    return (OAUTH_TOKEN or "").split("-")[0]
 
 
-def tweet_string(message, log, media=None):
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-
-    log.setLevel(logging.ERROR)
-    api = tweepy.Client(
-        bearer_token=BEARER_TOKEN,
-        access_token=OAUTH_TOKEN,
-        access_token_secret=OAUTH_TOKEN_SECRET,
-        consumer_key=APP_KEY,
-        consumer_secret=APP_SECRET
-    )
-
-    uploaded_media = None
-    if media:
+def endpoint_key(request):
+    # Rate limits are per endpoint, so ids in the path don't matter (short numbers are API versions)
+    return request.method + " " + re.sub(r"/\d{3,}", "/:id", urlsplit(request.url).path)
+
+
+def respect_rate_limit(endpoint, max_wait=None):
+    limit = rate_limits.get(endpoint)
+    if limit and limit["remaining"] <= 0:
+        wait = limit["reset"] - time.time() + 1
+        if max_wait is not None and wait > max_wait:
+            raise RateLimited("Rate limit for %s used up for another %ds" % (endpoint, wait))
+        if wait > 0:
+            logging.getLogger(__name__).info("Rate limit for %s used up, sleeping %ds", endpoint, wait)
+            time.sleep(wait)
+
+
+def record_rate_limit(endpoint, headers):
+    global rate_limits_changed
+    if 'x-rate-limit-remaining' in headers and 'x-rate-limit-reset' in headers:
+        rate_limits[endpoint] = {"remaining": int(headers['x-rate-limit-remaining']),
+                                 "reset": int(headers['x-rate-limit-reset'])}
+        rate_limits_changed = True
+
+
+def load_rate_limits():
+    rate_limits.clear()
+    rate_limits.update(load_cache().get("rate_limits", {}).get(token_user_id(), {}))
+
+
+def save_rate_limits():
+    global rate_limits_changed
+    if rate_limits_changed and token_user_id():
+        now = time.time()
+        cache = load_cache()
+        cache.setdefault("rate_limits", {})[token_user_id()] = {k: v for k, v in rate_limits.items()
+                                                                  if v["reset"] > now}
+        save_cache(cache)
+        rate_limits_changed = False
+
+
+atexit.register(save_rate_limits)
+
+
+def keep_alive(session, max_wait=None):
+    # Bigger connection pool so paged and repeated calls keep reusing warm TLS connections. Every request
+    # through it waits out a used up rate limit window first (up to max_wait seconds, if given) and records the
+    # limits in the response.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    send = adapter.send
+
+    def send_within_rate_limit(request, **kwargs):
+        endpoint = endpoint_key(request)
+        respect_rate_limit(endpoint, max_wait)
+        response = send(request, **kwargs)
+        record_rate_limit(endpoint, response.headers)
+        return response
+
+    adapter.send = send_within_rate_limit
+    session.mount("https://", adapter)
+    return session
+
+
+def get_tweepy_client():
+    global tweepy_client
+    if tweepy_client is None:
+        tweepy_client = tweepy.Client(
+            bearer_token=BEARER_TOKEN,
+            access_token=OAUTH_TOKEN,
+            access_token_secret=OAUTH_TOKEN_SECRET,
+            consumer_key=APP_KEY,
+            consumer_secret=APP_SECRET,
+            # Sleep until the window resets when a rate limit runs out instead of failing with 429
+            wait_on_rate_limit=True
+        )
+        keep_alive(tweepy_client.session)
+    return tweepy_client
+
+
+def get_tweet_client():
+    # Same as get_tweepy_client() but a used up rate limit raises TooManyRequests instead of sleeping until
+    # the window resets, which can be hours away for tweets
+    global tweet_client
+    if tweet_client is None:
+        tweet_client = tweepy.Client(
+            bearer_token=BEARER_TOKEN,
+            access_token=OAUTH_TOKEN,
+            access_token_secret=OAUTH_TOKEN_SECRET,
+            consumer_key=APP_KEY,
+            consumer_secret=APP_SECRET
+        )
+        keep_alive(tweet_client.session, RATE_LIMIT_MAX_WAIT)
+    return tweet_client
+
+
+def get_media_api():
+    # Media uploads still go through the v1.1 API
+    global media_api
+    if media_api is None:
         auth = tweepy.OAuth1UserHandler(
             APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET
         )
-        oldapi = tweepy.API(auth)
-        uploaded_media = oldapi.media_upload(filename=media)
+        media_api = tweepy.API(auth)
+        keep_alive(media_api.session, RATE_LIMIT_MAX_WAIT)
+    return media_api
+
+
+@contextlib.contextmanager
+def quiet():
+    # Twitter libraries log a lot at lower levels, only let errors through while calling them. Nested and
+    # concurrent uses share one level change (setLevel clears every logger's level cache), the first in sets
+    # it and the last out restores it.
+    global quiet_depth
+    with quiet_lock:
+        if quiet_depth == 0:
+            for name in LIBRARY_LOGGERS:
+                logger = logging.getLogger(name)
+                quiet_levels[name] = logger.level
+                logger.setLevel(logging.ERROR)
+        quiet_depth += 1
+    try:
+        yield
+    finally:
+        with quiet_lock:
+            quiet_depth -= 1
+            if quiet_depth == 0:
+                for name, level in quiet_levels.items():
+                    logging.getLogger(name).setLevel(level)
+
+
+def setup_twitter():
+    global twitter_ready, tweepy, requests, AUTH_ERRORS
+    if not twitter_ready:
+        check_twitter_config()
+        import tweepy
+        import requests.adapters
+        AUTH_ERRORS = (tweepy.Unauthorized, tweepy.Forbidden)
+        load_rate_limits()
+        logging.captureWarnings(True)
+        twitter_ready = True
+
+
+def twitter_auth_issue(log, e):
+    log.error("There was a problem with automated tweet operations:\n\n%s\nPlease investigate.", e)
+
+
+def retry_wait(e, attempt):
+    # Wait the server asked for (Retry-After, or until a used up rate limit resets), exponential backoff otherwise.
+    # Never more than a minute, a longer wait is left to the rate limit check on the next attempt.
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if "retry-after" in headers:
+            return min(60, max(1, int(headers["retry-after"])))
+        if headers.get("x-rate-limit-remaining") == "0" and "x-rate-limit-reset" in headers:
+            return min(60, max(1, int(headers["x-rate-limit-reset"]) - int(time.time())))
+    except ValueError:
+        pass
+    return min(60, 2 ** attempt) + random.uniform(0, 1)
+
+
+def tweet_string(message, log, media=None):
+    # Returns True once the tweet is posted, problems are logged and give False
+    setup_twitter()
+    api = get_tweet_client()
+
+    # One quiet() for the upload and all attempts rather than one per call
+    with quiet():
+        uploaded_media = None
+        if media:
+            try:
+                uploaded_media = get_media_api().media_upload(filename=media)
+            except (tweepy.TooManyRequests, RateLimited):
+                log.error("   Media upload rate limit used up, not tweeting")
+                return False
+            except Exception:
+                log.exception("   Problem trying to upload media %s", media)
+                return False
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                if uploaded_media:
+                    api.create_tweet(
+                        text=message,
+                        media_ids=[uploaded_media.media_id]
+                    )
+                else:
+                    api.create_tweet(
+                        text=message
+                    )
+                return True
+            except (tweepy.TwitterServerError, requests.ConnectionError, requests.Timeout) as e:
+                log.exception("   Problem trying to tweet string")
+                error = e
+            except (tweepy.TooManyRequests, RateLimited):
+                log.error("   Tweet rate limit used up, not tweeting")
+                return False
+            except Exception as e:
+                log.exception("   Problem trying to tweet string")
+                twitter_auth_issue(log, e)
+                return False
+            if attempt < MAX_RETRIES - 1:
+                time.sleep(retry_wait(error, attempt))
 
-    retries = 0
-    while retries < 2:
-        log.setLevel(logging.ERROR)
-        try:
-            if uploaded_media:
-                api.create_tweet(
-                    text=message,
-                    media_ids=[uploaded_media.media_id]
-                )
-            else:
-                api.create_tweet(
-                    text=message
-                )
-            break
-        except Exception as e:
-            log.setLevel(old_level)
-            log.exception("   Problem trying to tweet string")
-            twitter_auth_issue(e)
-            return
-        except:
-            log.setLevel(old_level)
-            log.exception("   Problem trying to tweet string")
-        retries += 1
-        s = random.randrange(5, 10 * retries)
-        log.debug("sleeping %d seconds for retry", s)
-        time.sleep(s)
-
-    log.setLevel(old_level)
-    if retries == 5:
         log.error("Couldn't tweet string: %s with media: %s", message, media)
+        return False
 
 
 def tweet_price(price, log, stock, extra="", image=None):
     log.debug("Tweet about stock price for %s: $%s", stock, price)
     message = "$%s current stock price: $%s. %s #bot" % (stock, price, extra)
-    tweet_string(message=message, log=log, media=image)
+    return tweet_string(message=message, log=log, media=image)
 
 
 def tweet_search(log, item, limit=50, since_id=None):
-    log.debug("Searching twitter for '%s'", item)
-    check_twitter_config()
+    # Recent tweets matching item, in the v1.1 search result layout ({"statuses": [...], "search_metadata": ...})
+    # Reject oversize queries before they get formatted into the log or sent anywhere
     if len(item) > 500:
         log.error("      Search string too long")
-        raise Exception("Search string too long: %d", len(item))
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+        raise Exception("Search string too long: %d" % len(item))
+    log.debug("Searching twitter for '%s'", item)
+    setup_twitter()
+    api = get_tweepy_client()
     try:
-        result = twitter.search(q=item, count=limit, since_id=since_id)
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
-        twitter_auth_issue(e)
+        with quiet():
+            # Recent search returns between 10 and 100 tweets per request
+            response = api.search_recent_tweets(query=item, max_results=min(100, max(10, limit)),
+                                                since_id=since_id, user_auth=True)
+    except AUTH_ERRORS as e:
+        twitter_auth_issue(log, e)
         raise
-    except:
-        log.setLevel(old_level)
+    return {"statuses": [t.data for t in response.data or []], "search_metadata": response.meta}
+
+
+def stream_search(log, item, on_tweet):
+    # Call on_tweet with each new tweet matching item as it is posted, blocks until the stream is disconnected.
+    # For "watch for new tweets" loops this beats polling tweet_search: one long lived connection delivers matches
+    # within a second or so and doesn't use up the search rate limit. tweet_search is still the one to use for a
+    # one off look at what is already there. The stream only has the rules set here, any older ones are removed.
+    log.debug("Streaming twitter for '%s'", item)
+    setup_twitter()
+
+    class SearchStream(tweepy.StreamingClient):
+        def on_tweet(self, tweet):
+            on_tweet(tweet.data)
+
+        def on_request_error(self, status_code):
+            log.error("   Twitter stream error: %s", status_code)
+            if status_code in (401, 403):
+                self.disconnect()
+
+    # Filtered stream is app only, it needs the bearer token
+    stream = SearchStream(BEARER_TOKEN, wait_on_rate_limit=True)
+    try:
+        with quiet():
+            rules = stream.get_rules().data
+            if rules:
+                stream.delete_rules([rule.id for rule in rules])
+            stream.add_rules(tweepy.StreamRule(item))
+    except AUTH_ERRORS as e:
+        twitter_auth_issue(log, e)
         raise
-    log.setLevel(old_level)
-    return result
+    stream.filter()
+
+
+def user_details(user):
+    # v2 user data with the v1.1 style screen_name and followers_count keys added so it can be used the same way
+    details = dict(user.data)
+    details["screen_name"] = user.username
+    details["followers_count"] = user.public_metrics["followers_count"]
+    return details
+
+
+def get_user_id(log, screen_name):
+    if screen_name not in user_ids:
+        with quiet():
+            user = get_tweepy_client().get_user(username=screen_name, user_auth=True).data
+        if not user:
+            raise Exception("Unknown twitter user: %s" % screen_name)
+        user_ids[screen_name] = user.id
+    return user_ids[screen_name]
+
+
+@functools.lru_cache(maxsize=4096)
+def lookup_user(screen_name, user_fields=()):
+    # The same account is often looked up more than once in a run (e.g. as a follower and as a friend), so keep
+    # the results until clear_caches()
+    return get_tweepy_client().get_user(username=screen_name, user_fields=list(user_fields) or None,
+                                        user_auth=True).data
+
+
+def clear_caches():
+    user_ids.clear()
+    lookup_user.cache_clear()
 
 
 def check_relationship(log, id):
     my_screen_name = get_screen_name(log)
     if my_screen_name == "Unknown":
-        raise("Couldn't get my own screen name")
+        raise Exception("Couldn't get my own screen name")
     log.debug("Checking relationship of %s with me (%s)", id, my_screen_name)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+    setup_twitter()
     try:
-        result = twitter.show_friendship(source_screen_name=my_screen_name, target_screen_name=id)
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
+        with quiet():
+            user = lookup_user(id, ("connection_status",))
+    except AUTH_ERRORS as e:
         log.exception("   Problem trying to check relationship")
-        twitter_auth_issue(e)
-        raise
-    except:
+        twitter_auth_issue(log, e)
         raise
-    log.setLevel(old_level)
-    return result["relationship"]["source"]["following"], result["relationship"]["source"]["followed_by"]
+    status = user.get("connection_status", []) if user else []
+    return "following" in status, "followed_by" in status
 
 
 def follow_twitter_user(log, id):
     log.debug("Following %s", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+    setup_twitter()
     try:
-        twitter.create_friendship(screen_name=id)
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
+        user_id = get_user_id(log, id)
+        with quiet():
+            get_tweepy_client().follow_user(user_id)
+        lookup_user.cache_clear()
+    except AUTH_ERRORS as e:
         log.exception("   Problem trying to follow twitter user")
-        twitter_auth_issue(e)
+        twitter_auth_issue(log, e)
         raise
-    except:
-        raise
-    log.setLevel(old_level)
 
 
 def unfollow_twitter_user(log, id):
     log.debug("Unfollowing %s", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+    setup_twitter()
     try:
-        twitter.destroy_friendship(screen_name=id)
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
+        user_id = get_user_id(log, id)
+        with quiet():
+            get_tweepy_client().unfollow_user(user_id)
+        lookup_user.cache_clear()
+    except AUTH_ERRORS as e:
         log.exception("Error unfollowing %s", id)
-        twitter_auth_issue(e)
+        twitter_auth_issue(log, e)
         raise
-    except:
+    except Exception:
         log.exception("Error unfollowing %s", id)
-    log.setLevel(old_level)
 
 
 def get_account_details(log, id):
     log.debug("Getting account details for %s", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+    setup_twitter()
     try:
-        details = twitter.show_user(screen_name=id)
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
+        with quiet():
+            user = lookup_user(id, tuple(USER_FIELDS))
+    except AUTH_ERRORS as e:
         log.exception("   Problem trying to get account details")
-        twitter_auth_issue(e)
+        twitter_auth_issue(log, e)
         raise
-    except:
-        details = None
-    log.setLevel(old_level)
-    return details
+    except Exception:
+        user = None
+    return user_details(user) if user else None
+
+
+def get_accounts_details_bulk(log, ids):
+    # Details for many accounts at 100 per request instead of one get_account_details() call each. The requests
+    # run a few at a time, they spend nearly all their time waiting on the network.
+    setup_twitter()
+    api = get_tweepy_client()
+    ids = list(ids)
+
+    def get_chunk(chunk):
+        log.debug("Getting account details for %d accounts", len(chunk))
+        try:
+            with quiet():
+                return api.get_users(usernames=chunk, user_fields=USER_FIELDS, user_auth=True).data or []
+        except AUTH_ERRORS as e:
+            log.exception("   Problem trying to get account details")
+            twitter_auth_issue(log, e)
+            raise
+
+    chunks = [ids[start:start + 100] for start in range(0, len(ids), 100)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for users in executor.map(get_chunk, chunks):
+            for user in users:
+                yield user_details(user)
 
 
 def get_follower_count(log, id):
@@ -287,164 +541,154 @@ def get_follower_count(log, id):
         return None
 
 
+def get_follower_counts(log, ids):
+    # Follower counts for many accounts by screen name, using the batched lookup. Unknown accounts are left out.
+    log.debug("Getting follower counts for %d accounts", len(ids))
+    return {d["screen_name"]: d["followers_count"] for d in get_accounts_details_bulk(log, ids)}
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+
 def get_screen_name(log):
     global MYSELF
+    user_id = token_user_id()
+    if not MYSELF and user_id:
+        MYSELF = load_cache().get("screen_names", {}).get(user_id)
     if not MYSELF or MYSELF == "Unknown":
         log.debug("Getting current user screen name")
-        check_twitter_config()
-        logging.captureWarnings(True)
-        old_level = log.getEffectiveLevel()
-        log.setLevel(logging.ERROR)
-        twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+        setup_twitter()
         try:
-            details = twitter.verify_credentials()
-        except TwythonAuthError as e:
-            log.setLevel(old_level)
+            with quiet():
+                details = get_tweepy_client().get_me(user_auth=True).data
+        except AUTH_ERRORS as e:
             log.exception("   Problem trying to get screen name")
-            twitter_auth_issue(e)
+            twitter_auth_issue(log, e)
             raise
-        except:
+        except Exception:
             log.exception("   Problem trying to get screen name")
             details = None
-        log.setLevel(old_level)
         name = "Unknown"
         if details:
-            name = details["screen_name"]
+            name = details.username
+            if user_id:
+                cache = load_cache()
+                cache.setdefault("screen_names", {})[user_id] = name
+                save_cache(cache)
         MYSELF = name
     return MYSELF
 
 
-def get_following(log, id):
-    log.debug("Getting people %s is following", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
-    log.setLevel(old_level)
-
-    cursor = -1
-    max_loops = 15
-    while cursor != 0:
+def paged(log, fetch, max_pages=15):
+    # Pages from a paginated v2 call. The next page is fetched in the background while the caller works
+    # through the current one.
+    def get_page(token):
         try:
-            log.setLevel(logging.ERROR)
-            following = twitter.get_friends_list(screen_name=id, cursor=cursor, count=200)
-            log.setLevel(old_level)
-        except TwythonAuthError as e:
+            with quiet():
+                return fetch(pagination_token=token)
+        except AUTH_ERRORS as e:
             log.exception("   Problem trying to get people following")
-            twitter_auth_issue(e)
+            twitter_auth_issue(log, e)
             raise
-        except:
-            raise
-        for u in following["users"]:
-            yield u["screen_name"]
-        cursor = following["next_cursor"]
-        if cursor:
-            s = random.randint(55, 65)
-            log.debug("Sleeping %ds to avoid rate limit. Cursor: %s", s, cursor)
-            time.sleep(s)
-        else:
-            log.debug("Normal query end")
-
-        max_loops -= 1
-        if max_loops <= 0:
-            log.debug("Killing search due to max loops")
-            break
-    log.setLevel(old_level)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(get_page, None)
+        for n in range(max_pages):
+            page = future.result()
+            token = page.meta.get("next_token")
+            if token and n < max_pages - 1:
+                future = executor.submit(get_page, token)
+            yield page
+            if not token:
+                log.debug("Normal query end")
+                return
+        log.debug("Killing search due to max loops")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_following(log, id):
+    log.debug("Getting people %s is following", id)
+    setup_twitter()
+    api = get_tweepy_client()
+    user_id = get_user_id(log, id)
+    pages = paged(log, lambda pagination_token: api.get_users_following(user_id, max_results=1000,
+                                                                        pagination_token=pagination_token,
+                                                                        user_auth=True))
+    for u in itertools.chain.from_iterable(page.data or [] for page in pages):
+        yield u.username
 
 
 def get_followers(log, id):
     log.debug("Getting people following % s", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
-    log.setLevel(old_level)
-
-    cursor = -1
-    max_loops = 15
-    while cursor != 0:
-        try:
-            log.setLevel(logging.ERROR)
-            following = twitter.get_followers_list(screen_name=id, cursor=cursor, count=200)
-            log.setLevel(old_level)
-        except TwythonAuthError as e:
-            log.exception("   Problem trying to get people following")
-            twitter_auth_issue(e)
-            raise
-        except:
-            raise
-        for u in following["users"]:
-            yield u
-        cursor = following["next_cursor"]
-        if cursor:
-            s = random.randint(55, 65)
-            log.debug("Sleeping %ds to avoid rate limit. Cursor: %s", s, cursor)
-            time.sleep(s)
-        else:
-            log.debug("Normal query end")
-
-        max_loops -= 1
-        if max_loops <= 0:
-            log.debug("Killing search due to max loops")
-            break
-    log.setLevel(old_level)
+    setup_twitter()
+    api = get_tweepy_client()
+    user_id = get_user_id(log, id)
+    pages = paged(log, lambda pagination_token: api.get_users_followers(user_id, max_results=1000,
+                                                                        pagination_token=pagination_token,
+                                                                        user_fields=USER_FIELDS,
+                                                                        user_auth=True))
+    for u in itertools.chain.from_iterable(page.data or [] for page in pages):
+        yield user_details(u)
 
 
 def favorite_tweet(log, id):
     log.debug("Favoriting tweet % s", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
-    log.setLevel(old_level)
+    setup_twitter()
     try:
-        log.setLevel(logging.ERROR)
-        res = twitter.create_favorite(id=id)
-        log.setLevel(old_level)
-        return res
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
-        if 'You have already favorited this status' in str(e):
-            log.info("tweet already favorited")
-        else:
-            log.exception("Problem trying to favorite tweet")
-            twitter_auth_issue(e)
+        with quiet():
+            return get_tweepy_client().like(id)
+    except AUTH_ERRORS as e:
+        log.exception("Problem trying to favorite tweet")
+        twitter_auth_issue(log, e)
         raise
 
 
 def retweet_tweet(log, id):
     log.debug("Retweeting tweet % s", id)
-    check_twitter_config()
-    logging.captureWarnings(True)
-    old_level = log.getEffectiveLevel()
-    log.setLevel(logging.ERROR)
-    twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
-    log.setLevel(old_level)
+    setup_twitter()
     try:
-        log.setLevel(logging.ERROR)
-        res = twitter.retweet(id=id)
-        log.setLevel(old_level)
-        return res
-    except TwythonAuthError as e:
-        log.setLevel(old_level)
-        if 'You have already retweeted this status' in str(e):
-            log.info("tweet already retweeted")
-        else:
-            log.exception("Problem trying to retweeted tweet")
-            twitter_auth_issue(e)
+        with quiet():
+            return get_tweepy_client().retweet(id)
+    except AUTH_ERRORS as e:
+        log.exception("Problem trying to retweeted tweet")
+        twitter_auth_issue(log, e)
         raise
 
 
+def random_jpg(directory):
+    # Pick a random .jpg from directory in one pass over its entries without building a list (reservoir sampling)
+    chosen = None
+    jpgs = (entry.path for entry in os.scandir(directory) if entry.name.endswith('.jpg'))
+    for i, path in enumerate(jpgs):
+        if random.randrange(i + 1) == 0:
+            chosen = path
+    return chosen
+
+
 def main():
+    import argparse
     parser = argparse.ArgumentParser(description='Tweet testing')
     parser.add_argument('--pic', help='Tweet a picture', required=False, action='store_true')
     args = parser.parse_args()
 
     if args.pic:
-        pic = random.choice(glob.glob('images/*.jpg'))
+        pic = random_jpg('images')
         message = "One of my favorite pictures #bot"
         print(f"Tweeting: '{message}' with pic: {pic}")
         log = logging.getLogger(__name__)
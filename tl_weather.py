@@ -25,24 +25,94 @@ Description:
 Uses the WEATHERAPI API to get weather at current location
 
 Requires a WEATHERAPI API key. Visit them to get one: https://www.weatherapi.com
-Uses http://ipinfo.io to look up current location
+Uses https://ipinfo.io to look up current location
 """
 
 import os
-import urllib.request, urllib.parse, urllib.error
+import time
+import hashlib
 import datetime
 import json
-
-WEATHERAPI_API_KEY = None
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WEATHERAPI_API_KEY = os.environ.get('WEATHERAPI_API_KEY')
 WEATHERAPI_URL = "https://api.weatherapi.com/v1/history.json?key=%s&q=%s&dt=%s"
 WEATHERAPI_URL_NO_TIME = "https://api.weatherapi.com/v1/current.json?key=%s&q=%s&aqi=no"
 
-if not WEATHERAPI_API_KEY and 'WEATHERAPI_API_KEY' in os.environ:
-    WEATHERAPI_API_KEY = os.environ['WEATHERAPI_API_KEY']
-
 if not WEATHERAPI_API_KEY:
     raise Exception("WEATHERAPI_API_KEY missing for weather data")
 
+# Shared session so the ipinfo and weather lookups (and repeated calls) reuse their TLS connections
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# Connect and read timeouts in seconds
+LOCATION_TIMEOUT = (3.05, 5)
+WEATHER_TIMEOUT = (3.05, 10)
+
+# Location found through ipinfo.io is reused for this many seconds, it rarely changes between calls
+LOCATION_TTL = 3600
+location_cache = {"loc": None, "time": 0}
+
+# Weather for days that are over doesn't change, so history responses are kept on disk, one file per location and day
+HISTORY_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'tl_weather')
+
+
+def loads(data):
+    # orjson parses the larger history responses a good deal faster when it's installed
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def clear_location_cache():
+    location_cache.update(loc=None, time=0)
+
+
+def history_cache_file(location, weather_time):
+    # Only past days are cached, today's history is still filling in
+    try:
+        day = datetime.date.fromtimestamp(float(weather_time))
+    except (TypeError, ValueError):
+        try:
+            day = datetime.date.fromisoformat(str(weather_time))
+        except ValueError:
+            return None
+    if day >= datetime.date.today():
+        return None
+    key = "weatherapi:%s:%s" % (location, weather_time)
+    return os.path.join(HISTORY_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+
+def load_history(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def save_history(cache_file, data):
+    try:
+        os.makedirs(HISTORY_CACHE_DIR, exist_ok=True)
+        # Write and rename so a concurrent reader never sees half a file
+        with open(cache_file + ".tmp", 'wb') as f:
+            f.write(data)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        pass
+
+
+def clock_seconds(clock):
+    # Seconds since midnight for a WeatherAPI "hh:mm AM" time, much cheaper than strptime
+    hm, am_pm = clock.split()
+    hours, minutes = hm.split(":")
+    seconds = int(hours) % 12 * 3600 + int(minutes) * 60
+    return seconds + 12 * 3600 if am_pm.upper() == "PM" else seconds
+
 
 def get_daytime_weather_data(log, weather_time=None, location=None):
     """
@@ -52,14 +122,20 @@ def get_daytime_weather_data(log, weather_time=None, location=None):
     :param weather_time: YYYY-MM-DD to get weather for
     """
 
+    if not location and location_cache["loc"] and time.time() - location_cache["time"] < LOCATION_TTL:
+        location = location_cache["loc"]
+
     if not location:
         # Get current location
         try:
-            l = json.load(urllib.request.urlopen('http://ipinfo.io/json'))
+            response = session.get('https://ipinfo.io/json', timeout=LOCATION_TIMEOUT)
+            response.raise_for_status()
+            l = loads(response.content)
             location = l["loc"]
             if log:
-                log.debug("Get weather data for %s (%s) at %s",
-                          l["city"], location, datetime.datetime.fromtimestamp(weather_time))
+                # weather_time can be a timestamp or a YYYY-MM-DD string, log it as given
+                log.debug("Get weather data for %s (%s) at %s", l.get("city"), location, weather_time)
+            location_cache.update(loc=location, time=time.time())
         except:
             # Default to Statue of Liberty in NY if we can't get current location
             location = "40.689249,-74.0445"
@@ -68,32 +144,41 @@ def get_daytime_weather_data(log, weather_time=None, location=None):
     weather_info = {}
 
     if weather_time:
-        fp = urllib.request.urlopen(WEATHERAPI_URL % (WEATHERAPI_API_KEY, location, weather_time))
+        url = WEATHERAPI_URL % (WEATHERAPI_API_KEY, location, weather_time)
     else:
-        fp = urllib.request.urlopen(WEATHERAPI_URL_NO_TIME % (WEATHERAPI_API_KEY, location))
-
-    data = fp.read()
+        url = WEATHERAPI_URL_NO_TIME % (WEATHERAPI_API_KEY, location)
+
+    cache_file = history_cache_file(location, weather_time) if weather_time else None
+    data = load_history(cache_file) if cache_file else None
+    cached = data is not None
+    if not cached:
+        response = session.get(url, timeout=WEATHER_TIMEOUT)
+        response.raise_for_status()
+        data = response.content
     try:
-        weather = json.loads(data)
+        weather = loads(data)
     except:
         raise Exception("Can't decode weather data response:\n%s" % data)
+    if cache_file and not cached:
+        save_history(cache_file, data)
 
     if log:
         # Uncomment if you want to see the gory details
         pass
         # log.debug("Weather details: %s", weather)
 
-    # Compute hours of daylight
-    daylight = 0
-    if "forecast" in weather and "forecastday" in weather["forecast"] and \
-            "astro" in weather["forecast"]["forecastday"][0]:
-        astro = weather["forecast"]["forecastday"][0]["astro"]
-        sunrise = datetime.datetime.strptime(astro["sunrise"], '%I:%M %p')
-        sunset = datetime.datetime.strptime(astro["sunset"], '%I:%M %p')
-        daylight = (sunset - sunrise).total_seconds() / 60.0 / 60.0
-
-    if "forecast" in weather and "forecastday" in weather["forecast"]:
-        day_weather = weather["forecast"]["forecastday"][0]["day"]
+    forecastday = weather.get("forecast", {}).get("forecastday")
+    day0 = forecastday[0] if forecastday else None
+
+    if day0 is not None:
+        # Compute hours of daylight
+        daylight = 0
+        if "astro" in day0:
+            astro = day0["astro"]
+            # Sunset past midnight wraps into the next day
+            daylight = (clock_seconds(astro["sunset"]) - clock_seconds(astro["sunrise"])) % 86400 / 60.0 / 60.0
+
+        day_weather = day0["day"]
         weather_info["cloud_cover"] = day_weather['condition']['text']
         weather_info["daylight"] = daylight
         weather_info["description"] = day_weather['condition']['text']